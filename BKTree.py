@@ -0,0 +1,108 @@
+import heapq
+import operator
+import numpy as np
+from profiler import count
+
+
+class BKTree:
+    def __init__(self, dataset):
+        """
+        A Burkhard-Keller tree over the train examples. Every child hangs
+        under its hamming distance to the parent, equal examples share a node
+        :param dataset: the train Dataset
+        """
+        self.dataset = dataset
+        self.root = None
+        self.size = 0
+        self.evaluations = []
+        for index, row in enumerate(dataset.matrix.tolist()):
+            self.add(tuple(row), index)
+
+    def hamming_distance(self, row1, row2):
+        """
+        :param row1: first encoded example
+        :param row2: second encoded example
+        :return: hamming distance
+        """
+        return sum(map(operator.ne, row1, row2))
+
+    def add(self, row, index):
+        """
+        Adds an example to the tree, a node is [row, indices, childrens]
+        :param row: the encoded example
+        :param index: its index in the train set
+        :return: nothing
+        """
+        if self.root is None:
+            self.root = [row, [index], {}]
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            distance = self.hamming_distance(row, node[0])
+            if distance == 0:
+                node[1].append(index)
+                return
+            childrens = node[2]
+            if distance not in childrens:
+                childrens[distance] = [row, [index], {}]
+                self.size += 1
+                return
+            node = childrens[distance]
+
+    def nearest(self, query, k):
+        """
+        The exact k nearest train examples of the query, a tie goes to the
+        earlier example in the train set. A child hanging at distance e from
+        a node at distance d from the query is at least |e - d| away from it
+        (triangle inequality), so it is skipped when that is above the k-th
+        best distance
+        :param query: the encoded query
+        :param k: number of neighbors
+        :return: the neighbors indices nearest first, and the number of
+        distances computed
+        """
+        best = []  # max heap of (-distance, -index)
+        evaluations = 0
+        if self.root is None:
+            return [], evaluations
+        frontier = [(0, 0, self.root)]
+        order = 1
+        while frontier:
+            bound, _, node = heapq.heappop(frontier)
+            if len(best) == k and bound > -best[0][0]:
+                break
+            distance = self.hamming_distance(query, node[0])
+            evaluations += 1
+            for index in node[1]:
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, -index))
+                elif (distance, index) < (-best[0][0], -best[0][1]):
+                    heapq.heapreplace(best, (-distance, -index))
+                else:
+                    break
+            limit = -best[0][0] if len(best) == k else None
+            for edge, child in node[2].items():
+                bound = abs(edge - distance)
+                if limit is None or bound <= limit:
+                    heapq.heappush(frontier, (bound, order, child))
+                    order += 1
+        neighbors = sorted((-distance, -index) for distance, index in best)
+        return [index for _, index in neighbors], evaluations
+
+    def neighbors(self, queries, k):
+        """
+        The k nearest neighbors of every query, the number of distances
+        computed for each query is kept in self.evaluations
+        :param queries: 2d array of encoded queries
+        :param k: number of neighbors
+        :return: list of neighbors index arrays
+        """
+        result = []
+        self.evaluations = []
+        for query in queries.tolist():
+            neighbors, evaluations = self.nearest(tuple(query), k)
+            result.append(np.array(neighbors, dtype=np.intp))
+            self.evaluations.append(evaluations)
+        count('KNN.distance_computations', sum(self.evaluations))
+        return result
@@ -0,0 +1,69 @@
+import numpy as np
+from Dataset import MISSING
+
+PACK_ROWS = 65536  # rows one hot encoded at a time while packing
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        """
+        :param words: array of unsigned integers
+        :return: the number of set bits, summed over the last axis
+        """
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+else:
+    BYTE_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        """
+        :param words: array of unsigned integers
+        :return: the number of set bits, summed over the last axis
+        """
+        counts = BYTE_COUNTS[words.view(np.uint8)]
+        return counts.sum(axis=-1, dtype=np.int32)
+
+
+class BitIndex:
+    def __init__(self, dataset):
+        """
+        Packs every train example into a bitset of its one hot encoding,
+        built once and used for all the distances
+        :param dataset: the train Dataset
+        """
+        self.dataset = dataset
+        self.width = dataset.matrix.shape[1]
+        self.bits = self.pack(dataset.matrix)
+
+    def pack(self, matrix):
+        """
+        The one hot encoding of the rows, packed in 64 bit words
+        :param matrix: 2d array of codes
+        :return: 2d array of uint64, a row per example
+        """
+        blocks = []
+        for start in range(0, len(matrix), PACK_ROWS):
+            blocks.append(np.packbits(self.dataset.one_hot(matrix[start:start + PACK_ROWS]), axis=1))
+        packed = np.concatenate(blocks) if blocks else np.zeros((0, 0), dtype=np.uint8)
+        columns = sum(self.dataset.cardinalities())
+        words = max(1, -(-columns // 64))
+        padded = np.zeros((len(matrix), words * 8), dtype=np.uint8)
+        padded[:, :packed.shape[1]] = packed
+        return padded.view(np.uint64)
+
+    def query_bytes(self):
+        """
+        :return: the memory needed for the distances of one query
+        """
+        return self.bits.nbytes + 4 * len(self.bits)
+
+    def distances(self, queries):
+        """
+        The hamming distances of the queries to the train set. Two equal
+        values share a bit, so xor counts two bits per different value,
+        and one bit per value that is missing in the query
+        :param queries: 2d array of encoded queries
+        :return: 2d array of distances, a row per query
+        """
+        packed = self.pack(queries)
+        missing = np.count_nonzero(queries == MISSING, axis=1)
+        counts = popcount(packed[:, np.newaxis, :] ^ self.bits[np.newaxis, :, :])
+        return (counts + missing[:, np.newaxis]) // 2
@@ -0,0 +1,266 @@
+import os
+import numpy as np
+from profiler import count
+
+MISSING = -1  # code given to a value that is not in the vocabulary
+
+
+def code_dtype(cardinality):
+    """
+    Picks the smallest signed integer type that can hold the codes
+    :param cardinality: the number of distinct values
+    :return: numpy dtype
+    """
+    if cardinality < np.iinfo(np.int8).max:
+        return np.int8
+    elif cardinality < np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+class Dataset:
+    def __init__(self, features, matrix, labels, vocabularies, label_vocabulary):
+        """
+        Initialization of an encoded dataset, every categorical value is
+        replaced by its index in the (sorted) vocabulary of its feature
+        :param features: the features, the class name is the last one
+        :param matrix: 2d array of codes, one row per example
+        :param labels: array of label codes
+        :param vocabularies: for each feature, the list of its values
+        :param label_vocabulary: the list of the labels
+        """
+        self.features = features
+        self.matrix = matrix
+        self.labels = labels
+        self.vocabularies = vocabularies
+        self.label_vocabulary = label_vocabulary
+        self.lookups = [{value: code for code, value in enumerate(vocabulary)} for vocabulary in vocabularies]
+        self.label_lookup = {label: code for code, label in enumerate(label_vocabulary)}
+
+    @classmethod
+    def from_rows(cls, features, rows, y_hat, reference=None):
+        """
+        Encodes rows of strings as read by train_set_reader
+        :param features: the features (with the class name last), may be None
+        :param rows: list of examples
+        :param y_hat: the tags
+        :param reference: a dataset to take the vocabularies from, if None
+        the vocabularies are built from the rows
+        :return: the dataset
+        """
+        if reference is not None:
+            vocabularies = reference.vocabularies
+            label_vocabulary = reference.label_vocabulary
+            features = reference.features
+        else:
+            width = len(rows[0]) if rows else len(features) - 1
+            vocabularies = [sorted(set(row[i] for row in rows)) for i in range(width)]
+            label_vocabulary = sorted(set(y_hat))
+            if features is None:
+                features = [str(i) for i in range(width)] + ['class']
+        dataset = cls(features, None, None, vocabularies, label_vocabulary)
+        dataset.matrix = dataset.encode(rows)
+        dataset.labels = dataset.encode_labels(y_hat)
+        return dataset
+
+    @classmethod
+    def from_file(cls, data, reference=None):
+        """
+        Reads and encodes a tab separated file, the first line is the features
+        :param data: path of the file
+        :param reference: a dataset to take the vocabularies from
+        :return: the dataset
+        """
+        rows = []
+        y_hat = []
+        with open(data) as file:
+            features = file.readline().rstrip('\n').split('\t')
+            for line in file:
+                example = line.rstrip('\n').split('\t')
+                y_hat.append(example.pop())
+                rows.append(example)
+        count('bytes_read', os.path.getsize(data))
+        count('rows_read', len(rows))
+        return cls.from_rows(features, rows, y_hat, reference)
+
+    def encode(self, rows):
+        """
+        Encodes rows of strings with the vocabularies of this dataset,
+        unknown values get the MISSING code
+        :param rows: list of examples
+        :return: 2d array of codes
+        """
+        width = len(self.vocabularies)
+        dtype = code_dtype(max([len(vocabulary) for vocabulary in self.vocabularies], default=0))
+        matrix = np.empty((len(rows), width), dtype=dtype)
+        for i in range(width):
+            lookup = self.lookups[i]
+            matrix[:, i] = [lookup.get(row[i], MISSING) for row in rows]
+        return matrix
+
+    def encode_row(self, row):
+        """
+        Encodes a single example
+        :param row: the example
+        :return: array of codes
+        """
+        return self.encode([row])[0]
+
+    def encode_labels(self, y_hat):
+        """
+        :param y_hat: the tags
+        :return: array of label codes
+        """
+        dtype = code_dtype(len(self.label_vocabulary))
+        return np.array([self.label_lookup.get(tag, MISSING) for tag in y_hat], dtype=dtype)
+
+    def decode_labels(self, codes):
+        """
+        :param codes: label codes
+        :return: the tags as strings, None for MISSING
+        """
+        return [self.label_vocabulary[code] if code != MISSING else None for code in codes]
+
+    def decode(self, matrix=None):
+        """
+        Decodes a matrix of codes back to rows of strings
+        :param matrix: the codes, this dataset matrix if None
+        :return: list of examples
+        """
+        if matrix is None:
+            matrix = self.matrix
+        return [[self.vocabularies[i][code] if code != MISSING else None for i, code in enumerate(row)]
+                for row in matrix.tolist()]
+
+    def recode(self, reference):
+        """
+        The same examples encoded with the vocabularies of another dataset,
+        a value missing there gets the MISSING code
+        :param reference: the dataset to take the vocabularies from
+        :return: the dataset
+        """
+        if reference.vocabularies is self.vocabularies:
+            return self
+        dtype = reference.encode([]).dtype
+        matrix = np.empty(self.matrix.shape, dtype=dtype)
+        for i, vocabulary in enumerate(self.vocabularies):
+            lookup = reference.lookups[i]
+            table = np.array([lookup.get(value, MISSING) for value in vocabulary] + [MISSING], dtype=dtype)
+            matrix[:, i] = table[self.matrix[:, i]]
+        table = np.array([reference.label_lookup.get(label, MISSING) for label in self.label_vocabulary] + [MISSING])
+        labels = table[self.labels].astype(reference.encode_labels([]).dtype)
+        return reference.like(matrix, labels)
+
+    def take(self, indices):
+        """
+        A new dataset with the given rows, sharing the vocabularies
+        :param indices: row indices
+        :return: the dataset
+        """
+        return self.like(self.matrix[indices], self.labels[indices])
+
+    def like(self, matrix, labels):
+        """
+        A new dataset with the given codes, sharing the vocabularies
+        :param matrix: 2d array of codes
+        :param labels: array of label codes
+        :return: the dataset
+        """
+        dataset = Dataset.__new__(Dataset)
+        dataset.__dict__.update(self.__dict__)
+        dataset.matrix = matrix
+        dataset.labels = labels
+        return dataset
+
+    def offsets(self):
+        """
+        :return: for each feature, the column of its first value in the one hot encoding
+        """
+        return np.concatenate(([0], np.cumsum(self.cardinalities())[:-1])).astype(np.intp)
+
+    def one_hot(self, matrix=None, dtype=np.uint8):
+        """
+        One hot encoding of a matrix of codes, a column per (feature, value),
+        a MISSING code sets no column
+        :param matrix: the codes, this dataset matrix if None
+        :param dtype: type of the result
+        :return: 2d array with a row per example
+        """
+        if matrix is None:
+            matrix = self.matrix
+        encoded = np.zeros((len(matrix), sum(self.cardinalities())), dtype=dtype)
+        columns = matrix.astype(np.intp) + self.offsets()
+        rows, features = np.nonzero(matrix != MISSING)
+        encoded[rows, columns[rows, features]] = 1
+        return encoded
+
+    def empty(self):
+        """
+        :return: a dataset without rows, sharing the vocabularies
+        """
+        return self.like(self.matrix[:0].copy(), self.labels[:0].copy())
+
+    def attributes(self):
+        """
+        :return: the features without the class name
+        """
+        return self.features[:-1]
+
+    def cardinalities(self):
+        """
+        :return: the number of values of each feature
+        """
+        return [len(vocabulary) for vocabulary in self.vocabularies]
+
+    def __len__(self):
+        return len(self.matrix)
+
+
+def as_dataset(features, train_set, y_hat, reference=None):
+    """
+    Returns the training data as a dataset, encoding it if it is given as lists
+    :param features: the features, may be None
+    :param train_set: a Dataset, or the train set as read by train_set_reader
+    :param y_hat: the tags, unused for a Dataset
+    :param reference: a dataset to take the vocabularies from
+    :return: the dataset
+    """
+    if isinstance(train_set, Dataset):
+        return train_set
+    return Dataset.from_rows(features, train_set, y_hat, reference)
+
+
+def encode_query(dataset, to_predict):
+    """
+    Encodes what a model was asked to predict
+    :param dataset: the training dataset of the model
+    :param to_predict: a Dataset, a list of examples or a single example
+    :return: 2d array of codes, and True if a single example was given
+    """
+    if isinstance(to_predict, Dataset):
+        return to_predict.recode(dataset).matrix, False
+    if isinstance(to_predict, np.ndarray):
+        if to_predict.ndim == 1:
+            return to_predict.reshape(1, -1), True
+        return to_predict, False
+    if not to_predict or isinstance(to_predict[0], list):
+        return dataset.encode(to_predict), False
+    return dataset.encode([to_predict]), True
+
+
+def unique_rows(matrix):
+    """
+    Finds the distinct rows of a matrix, in the order they first appear
+    :param matrix: 2d array of codes
+    :return: the index of the first copy of every distinct row, and for
+    every row the position of its distinct row
+    """
+    if not len(matrix) or not matrix.shape[1]:
+        return np.zeros(min(1, len(matrix)), dtype=np.intp), np.zeros(len(matrix), dtype=np.intp)
+    rows = np.ascontiguousarray(matrix)
+    keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
@@ -1,43 +1,107 @@
 import random
-from Node import Node
+import numpy as np
+from Node import Node, memory_report
+from FlatTree import FlatTree
+from Dataset import as_dataset, encode_query
+from WeightedDataset import WeightedDataset
+from persistence import write_arrays, read_arrays, dataset_meta, dataset_from
+from parallel import run_shared, worker_count
+from profiler import count, phase
 import math
 
 
 class DecisionTree:
-    def __init__(self, features, train_set, y_hat):
+    def __init__(self, features, train_set=None, y_hat=None, workers=1, parallel_rows=2000, seed=None):
         """
         Initialize the decision tree model
-        :param features: features
-        :param train_set: the train set
-        :param y_hat: the y hats
-        """
-        self.features = features.copy()
-        del self.features[-1]
+        :param features: features, a Dataset or a WeightedDataset
+        :param train_set: the train set, unused for a Dataset
+        :param y_hat: the y hats, unused for a Dataset
+        :param workers: number of processes building subtrees, None for all the cores
+        :param parallel_rows: a subtree with at least that many examples is
+        built by a worker
+        :param seed: if given, a tie in mode() is decided by a random
+        generator seeded by the seed and the path of the node, so the tree
+        does not depend on the order the nodes are built in. Building in
+        parallel picks a seed when it is None
+        """
+        self.workers = worker_count(workers)
+        self.parallel_rows = parallel_rows
+        self.seed = seed
+        if self.workers > 1 and self.seed is None:
+            self.seed = random.getrandbits(32)
+        self.deferred = None
+        self.weights = None  # the number of copies of every example of a WeightedDataset
+        if isinstance(features, WeightedDataset):
+            self.dataset, self.weights = features.pairs()
+        else:
+            self.dataset = as_dataset(features, train_set if train_set is not None else features, y_hat)
+        self.features = self.dataset.attributes()
         self.feature_index = self.feature_index_dict()
-        self.train_set = train_set
-        self.y_hat = y_hat
+        self.train_set = self.dataset.matrix
+        self.y_hat = self.dataset.labels
+        self.yes_code = self.dataset.label_lookup.get('yes', len(self.dataset.label_vocabulary))
+        self.no_code = self.dataset.label_lookup.get('no', len(self.dataset.label_vocabulary))
+        self.labels = max(len(self.dataset.label_vocabulary), self.yes_code + 1, self.no_code + 1)
+        self.offsets = self.dataset.offsets()
         self.examples = self.build_examples_with_tags()
         self.feature_values_dict = self.init_feature_values()
-        self.tree = self.build_tree()
+        with phase('DecisionTree.train'):
+            self.tree = self.build_tree()
         self.tree.set_is_root()
+        with phase('DecisionTree.compile'):
+            self.flat_tree = FlatTree.from_node(self.tree, self.dataset, self.weights)
         self.tabs = 0
 
-    def ID3(self, examples, attributes, default, value):
+    def save(self, path):
+        """
+        Saves the model in the binary format of persistence, the arrays of the flat tree
+        :param path: the file
+        :return: nothing
+        """
+        flat = self.flat_tree
+        arrays = {'matrix': self.dataset.matrix[:0], 'labels': self.dataset.labels[:0],
+                  'features': flat.features, 'children_start': flat.children_start,
+                  'children': flat.children, 'tags': flat.labels, 'fallbacks': flat.fallbacks}
+        write_arrays(path, 'DecisionTree', dataset_meta(self.dataset), arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model of save without training, the flat tree is memory
+        mapped and the tree of Node is rebuilt from it
+        :param path: the file
+        :return: the model
+        """
+        meta, arrays = read_arrays(path, 'DecisionTree')
+        model = cls.__new__(cls)
+        model.dataset = dataset_from(meta, arrays['matrix'], arrays['labels'])
+        model.features = model.dataset.attributes()
+        model.feature_index = model.feature_index_dict()
+        model.flat_tree = FlatTree(arrays['features'], arrays['children_start'], arrays['children'],
+                                   arrays['tags'], arrays['fallbacks'])
+        model.tree = model.flat_tree.to_node(model.dataset)
+        model.tabs = 0
+        return model
+
+    def ID3(self, examples, attributes, default, value, path=()):
         """
         The ID3 algorithm, recursively builds the tree choosing the best att each time
-        :param examples: the examples
+        :param examples: the examples, an array of row indices into the train set
         :param attributes: the attributes
         :param default: the default value
         :param value: the best value
+        :param path: the (feature index, value code) pairs from the root
         :return:
         """
+        count('DecisionTree.nodes_built')
         classification = self.check_classification(examples)
-        if not examples:
-            return Node(value, default, True)
+        if not len(examples):
+            return Node(value, default, True)  # an example of a WeightedDataset has at least one copy
         elif classification:
             return Node(value, classification, True)
         elif not attributes:
-            new_mode = self.mode(examples)
+            new_mode = self.mode(examples, path + ('leaf',))
             return Node(value, new_mode, True)
         else:
             best = self.choose_attribute(attributes, examples)
@@ -45,13 +109,20 @@ class DecisionTree:
             values = self.feature_values_dict[best]  # get all the values possible for this best attribute
             index = values[0]  # to get all the examples
             possible_values = self.get_values(values)
+            new_attributes = [attribute for attribute in attributes if attribute != best]  # shared by the childrens
+            examples_by_value = self.split_examples(index, examples)
             for val in possible_values:
-                new_examples = self.get_new_examples(index, val, examples)
-                new_attributes = attributes.copy()  # get the new attributes without the current
-                new_attributes.remove(best)
-                new_default = self.mode(new_examples)
-                sub_tree = self.ID3(new_examples, new_attributes, new_default, best)
-                tree.add_child(val, sub_tree)
+                new_examples = examples_by_value[val]
+                new_path = path + ((index, val),)
+                new_default = self.mode(new_examples, new_path)
+                key = val
+                if self.deferred is not None and len(new_examples) >= self.parallel_rows:
+                    # built by a worker, grafted in build_tree
+                    self.deferred.append((tree, key, (new_examples, new_attributes, new_default, best, new_path)))
+                    tree.add_child(key, None)
+                    continue
+                sub_tree = self.ID3(new_examples, new_attributes, new_default, best, new_path)
+                tree.add_child(key, sub_tree)
         return tree
 
     def feature_index_dict(self):
@@ -76,63 +147,47 @@ class DecisionTree:
             val.append(values[i])
         return val
 
-    def get_new_examples(self, index, attribute, examples):
+    def split_examples(self, index, examples):
         """
-        Builds the new examples from attribute and index
-        :param index: the index
-        :param attribute: the attribute
+        Splits the examples by their value of a feature, one stable sort
+        instead of a scan per value
+        :param index: the index of the feature
         :param examples: all the examples for now
-        :return: new list of examples
+        :return: list of the row indices of the examples, for each value code
         """
-        new_examples = []
-        for example in examples:
-            if example[index] == attribute:
-                new_examples.append(example)
-        return new_examples
+        count('DecisionTree.rows_scanned', len(examples))
+        column = self.train_set[examples, index]
+        order = np.argsort(column, kind='stable')
+        bounds = np.searchsorted(column[order], np.arange(len(self.dataset.vocabularies[index]) + 1))
+        return [examples[order[bounds[i]:bounds[i + 1]]] for i in range(len(bounds) - 1)]
 
     def init_feature_values(self):
         """
         Initialization of the features to a dictionary, and
-        for each feauture it's values
+        for each feauture it's index followed by the codes of it's values
+        (the vocabulary is sorted, so the values are by alphabet)
         :return: dictionary
         """
         feature_values_dict = {}
-        length = len(self.features)
-        for i in range(length):
-            feature_values_dict[self.features[i]] = []
-            feature_values_dict[self.features[i]].append(i)
-            for example in self.train_set:
-                att = example[i]
-                if att not in feature_values_dict[self.features[i]]:
-                    feature_values_dict[self.features[i]].append(att)
-        feature_values_dict = self.sort_feature_dict(feature_values_dict)
+        cardinalities = self.dataset.cardinalities()
+        for i in range(len(self.features)):
+            feature_values_dict[self.features[i]] = [i] + list(range(cardinalities[i]))
         return feature_values_dict
 
-    def sort_feature_dict(self, dictionary):
-        """
-        A helper function to sort the dictionary with values by alphabet
-        :param dictionary: a given dict
-        :return: sorted dict
-        """
-        for value in dictionary:
-            list_attributes = dictionary[value]
-            index = list_attributes[0]
-            list_attributes.remove(index)
-            list_attributes.sort()
-            list_attributes.insert(0, index)
-            dictionary[value] = list_attributes
-        return dictionary
-
-    def mode(self, examples):
+    def mode(self, examples, path=()):
         """
         :param examples: all examples
+        :param path: the path of the node, used with a seed
         :return: if yes equals no, uniformly choose, else,
         the max between them
         """
         yes, no = self.get_yes_no_labels_count(examples)
         if yes == no:
             vec = ['yes', 'no']
-            decide = random.choice(vec)
+            if self.seed is None:
+                decide = random.choice(vec)
+            else:
+                decide = random.Random('%d:%r' % (self.seed, path)).choice(vec)
             if decide == 'yes':
                 return 'yes'
             else:
@@ -148,14 +203,21 @@ class DecisionTree:
         :param examples: all examples
         :return: yes,no numbers
         """
-        num_yes = 0
-        num_no = 0
-        for example in examples:
-            if example[-1] == 'yes':
-                num_yes += 1
-            else:
-                num_no += 1
-        return num_yes, num_no
+        counts, total = self.label_counts(examples)
+        num_yes = int(counts[self.yes_code])
+        return num_yes, total - num_yes
+
+    def label_counts(self, examples):
+        """
+        Counting the examples of every label, with their copies
+        :param examples: all examples
+        :return: array of the count of every label, and the total
+        """
+        if self.weights is None:
+            return np.bincount(self.y_hat[examples], minlength=self.labels), len(examples)
+        weights = self.weights[examples]
+        counts = np.bincount(self.y_hat[examples], weights=weights, minlength=self.labels).astype(np.int64)
+        return counts, int(weights.sum())
 
     def check_classification(self, examples):
         """
@@ -164,9 +226,10 @@ class DecisionTree:
         :return: 'yes', or 'no' if all examples are tagge like that,
         else False
         """
-        if all([example[-1] == 'yes' for example in examples]):
+        counts, total = self.label_counts(examples)
+        if counts[self.yes_code] == total:
             return 'yes'
-        elif all([example[-1] == 'no' for example in examples]):
+        elif counts[self.no_code] == total:
             return 'no'
         else:
             return False
@@ -177,34 +240,53 @@ class DecisionTree:
         :return: the tree
         """
         default = self.mode(self.examples)
+        if self.workers > 1:
+            self.deferred = []
         self.tree = self.ID3(self.examples, self.features, default, None)
+        deferred = self.deferred
+        self.deferred = None
+        if deferred:
+            subtrees = run_shared(build_subtree, self, [arguments for _, _, arguments in deferred], self.workers)
+            for (parent, key, _), sub_tree in zip(deferred, subtrees):
+                parent.add_child(key, sub_tree)
         return self.tree
 
     def choose_attribute(self, attributes, examples):
         """
         Choosing the best attributes given the examples,
-        by calculating the total entropy, and the entropy for each feature
+        by calculating the total entropy, and the entropy for each feature.
+        The yes/no counts of every (feature, value) are one bincount over
+        the examples, the entropies are summed in the order the values
+        first appear, like a scan of the examples would
         :param attributes: attributes
         :param examples: examples
         :return:
         """
         total_yes, total_no = self.get_yes_no_labels_count(examples)
         total_entropy = self.calculate_entropy(total_yes, total_no)
+        indices = np.array([self.feature_index[feature] for feature in attributes], dtype=np.intp)
+        cells = self.train_set[np.ix_(examples, indices)].astype(np.intp) + self.offsets[indices]
+        tags = np.repeat(self.y_hat[examples].astype(np.intp), len(indices))
+        weights = None if self.weights is None else np.repeat(self.weights[examples], len(indices))
+        cell_count = self.offsets[-1] + len(self.dataset.vocabularies[-1])
+        counts = np.bincount(cells.ravel() * self.labels + tags, weights, minlength=cell_count * self.labels)
+        if weights is not None:
+            counts = counts.astype(np.int64)
+        counts = counts.reshape(-1, self.labels).tolist()
+        seen, first = np.unique(cells.ravel(), return_index=True)
+        seen = seen[np.argsort(first, kind='stable')]
+        count('DecisionTree.rows_scanned', len(examples))
+        count('DecisionTree.entropy_evaluations', len(seen) + 1)
+        feature_of_cell = np.searchsorted(self.offsets, seen, side='right') - 1
+        cells_by_feature = {index: [] for index in indices.tolist()}
+        for cell, index in zip(seen.tolist(), feature_of_cell.tolist()):
+            cells_by_feature[index].append(cell)
         ig_dictionary = {}
-        for feature in attributes:
-            dictionary = {}
+        for feature, index in zip(attributes, indices.tolist()):
             weighted_avg = 0
-            index = self.feature_values_dict[feature][0]
-            for example in examples:
-                att = example[index]  # we calculate how much for each attribute yes/no
-                if att in dictionary:
-                    dictionary[att][example[-1]] += 1
-                else:
-                    dictionary[att] = {'yes': 0, 'no': 0}
-                    dictionary[att][example[-1]] += 1
-            for att in dictionary:
-                yes = dictionary[att]['yes']
-                no = dictionary[att]['no']
+            for cell in cells_by_feature[index]:
+                yes = counts[cell][self.yes_code]
+                no = counts[cell][self.no_code]
                 entropy = self.calculate_entropy(yes, no)
                 weighted_avg += entropy * ((yes + no) / (total_yes + total_no))
             information_gain = total_entropy - weighted_avg
@@ -213,17 +295,11 @@ class DecisionTree:
 
     def build_examples_with_tags(self):
         """
-        Builds examples with tags
+        Builds the examples, the row indices into the encoded train set,
+        the tag of a row is self.y_hat[row]
         :return: examples with tags
         """
-        examples_tags = []
-        index = 0
-        for example, tag in zip(self.train_set, self.y_hat):
-            copied_example = example.copy()
-            examples_tags.append(copied_example)
-            examples_tags[index].insert(len(examples_tags[0]), tag)
-            index += 1
-        return examples_tags
+        return np.arange(len(self.train_set))
 
     def calculate_entropy(self, yes, no):
         """
@@ -267,24 +343,38 @@ class DecisionTree:
         :return: nothing
         """
         childrens = root.get_childrens()
-        for child in childrens:
-            if childrens[child].is_leaf():
+        vocabulary = self.dataset.vocabularies[root.get_index()] if childrens else None
+        for code in childrens:
+            child = vocabulary[code]
+            if childrens[code].is_leaf():
                 file.write(self.print_tabs(tabs))
-                file.write("|" + root.get_value() + "=" + child + ":" + childrens[child].get_default() + '\n')
+                file.write("|" + root.get_value() + "=" + child + ":" + childrens[code].get_default() + '\n')
             else:
                 file.write(self.print_tabs(tabs))
                 value = root.get_value()
                 if not root.is_root:
                     file.write("|" + value + "=" + child + '\n')
                     tabs += 1
-                    self.print_iterative(file, childrens[child], tabs)
+                    self.print_iterative(file, childrens[code], tabs)
                     tabs -= 1
                 else:
                     file.write(value + "=" + child + '\n')
                     tabs += 1
-                    self.print_iterative(file, childrens[child], tabs)
+                    self.print_iterative(file, childrens[code], tabs)
                     tabs -= 1
 
+    def memory_report(self):
+        """
+        The memory of the tree, against a tree of nodes with a __dict__
+        and of the compiled flat tree
+        :return: dictionary of sizes in bytes
+        """
+        report = memory_report(self.tree)
+        flat = self.flat_tree
+        arrays = (flat.features, flat.children_start, flat.children, flat.labels, flat.fallbacks)
+        report['flat_bytes'] = sum(array.nbytes for array in arrays)
+        return report
+
     def print_tabs(self, tabs):
         """
         Makes a string of tabs
@@ -298,37 +388,28 @@ class DecisionTree:
 
     def predict(self, to_predict):
         """
-        The function predicts the tags
-        :param to_predict: the test
+        The function predicts the tags, with the compiled tree. A value that
+        never appeared at a node gets the majority tag of the node
+        :param to_predict: an example, a list of examples or a Dataset
         :return: the predictions
         """
-        predictions = []
-        if all(isinstance(i, list) for i in to_predict):
-            for item in to_predict:
-                predictions.append(self.find_tag(self.tree, item, 'default'))
-            return predictions
-        else:
-            prediction = self.find_tag(self.tree, to_predict, 'default')
-            return prediction
+        queries, single = encode_query(self.dataset, to_predict)
+        with phase('DecisionTree.predict'):
+            count('DecisionTree.predictions', len(queries))
+            codes = self.flat_tree.predict_codes(queries)
+        predictions = self.dataset.decode_labels(codes)
+        if single:
+            return predictions[0]
+        return predictions
 
-    def find_tag(self, tree, item, tag):
+    def predict_iter(self, batches):
         """
-        The function finds the tag based on the item and the tag
-        :param item: the item we want to tag
-        :return: prediction (tag)
+        Predicts a stream of batches, like the chunks of utils.dataset_chunks
+        :param batches: iterable of Datasets or lists of examples
+        :return: generator of the predictions of every batch
         """
-        if tag == 'yes':
-            return 'yes'
-        elif tag == 'no':
-            return 'no'
-        else:
-            value = tree.get_value()
-            index = tree.get_index()
-            item_value = item[index]
-            childrens = tree.get_childrens()
-            next_node = childrens[item_value]
-            tag = next_node.get_default()
-            return self.find_tag(next_node, item, tag)
+        for batch in batches:
+            yield self.predict(batch)
 
     def test(self, test_set, y_hat_test):
         """
@@ -343,6 +424,7 @@ class DecisionTree:
         for tag in predictions:
             if tag == y_hat_test[index]:
                 acc += 1
+            index += 1
         acc = acc / len(y_hat_test)
         acc = self.truncate_number(acc, 2)
         return acc
@@ -360,3 +442,13 @@ class DecisionTree:
         if len(k) == 3:
             number += 0.01
         return number
+
+
+def build_subtree(model, arguments):
+    """
+    Builds a subtree of DecisionTree.build_tree in a worker
+    :param model: the DecisionTree, with the train set
+    :param arguments: the arguments of ID3
+    :return: the subtree
+    """
+    return model.ID3(*arguments)
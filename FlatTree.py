@@ -0,0 +1,141 @@
+import numpy as np
+from Dataset import MISSING
+from Node import Node
+
+LEAF = -1  # feature of a leaf node
+
+
+class FlatTree:
+    def __init__(self, features, children_start, children, labels, fallbacks):
+        """
+        A decision tree compiled to flat arrays, node 0 is the root
+        :param features: for each node the index of its feature, LEAF for a leaf
+        :param children_start: for each node the position of its first child
+        in children, the child of value code c is at children_start + c
+        :param children: the child nodes of all the nodes
+        :param labels: for each node its label code, the tag of a leaf
+        :param fallbacks: for each node the label code used when the value
+        of its feature was never seen in training
+        """
+        self.features = features
+        self.children_start = children_start
+        self.children = children
+        self.labels = labels
+        self.fallbacks = fallbacks
+
+    @classmethod
+    def from_node(cls, root, dataset, weights=None):
+        """
+        Compiles a tree of Node, nodes are numbered in breadth first order
+        :param root: the root Node, its childrens are keyed by value code
+        :param dataset: the train Dataset, the fallback of a node is the
+        majority label of the train examples reaching it
+        :param weights: the number of copies of every train example, if not one
+        :return: the flat tree
+        """
+        nodes = [root]
+        features = []
+        children_start = []
+        children = []
+        labels = []
+        position = 0
+        while position < len(nodes):
+            node = nodes[position]
+            position += 1
+            if node.is_leaf():
+                features.append(LEAF)
+                children_start.append(0)
+                labels.append(dataset.label_lookup.get(node.get_default(), MISSING))
+                continue
+            index = node.get_index()
+            features.append(index)
+            children_start.append(len(children))
+            labels.append(MISSING)
+            slots = [0] * len(dataset.vocabularies[index])
+            for value, child in node.get_childrens().items():
+                slots[value] = len(nodes)
+                nodes.append(child)
+            children.extend(slots)
+        flat = cls(np.array(features, dtype=np.int32), np.array(children_start, dtype=np.int32),
+                   np.array(children, dtype=np.int32), np.array(labels, dtype=np.int32),
+                   np.zeros(len(features), dtype=np.int32))
+        flat.fallbacks = flat.majority_labels(dataset.matrix, dataset.labels, len(dataset.label_vocabulary), weights)
+        return flat
+
+    def to_node(self, dataset):
+        """
+        Rebuilds the tree of Node, the inverse of from_node
+        :param dataset: a Dataset with the vocabularies of the tree
+        :return: the root Node
+        """
+        features = self.features.tolist()
+        starts = self.children_start.tolist()
+        labels = self.labels.tolist()
+        names = dataset.attributes()
+        nodes = [None] * len(features)
+        for position in range(len(features) - 1, -1, -1):
+            if features[position] == LEAF:
+                nodes[position] = Node(None, dataset.label_vocabulary[labels[position]], True)
+                continue
+            index = features[position]
+            node = Node(names[index], is_leaf=False, index=index)
+            for code in range(len(dataset.vocabularies[index])):
+                child = nodes[self.children[starts[position] + code]]
+                if child.is_leaf():
+                    child.value = names[index]
+                node.add_child(code, child)
+            nodes[position] = node
+        nodes[0].set_is_root()
+        return nodes[0]
+
+    def walk(self, queries, visit=None):
+        """
+        Walks all the queries down the tree together, one level per step
+        :param queries: 2d array of encoded queries
+        :param visit: if given, called with the nodes and the rows of every step
+        :return: the node each query stopped at, and True where it stopped
+        on a value that was never seen
+        """
+        rows = np.arange(len(queries))
+        nodes = np.zeros(len(queries), dtype=np.intp)
+        unseen = np.zeros(len(queries), dtype=bool)
+        while len(rows):
+            current = nodes[rows]
+            if visit is not None:
+                visit(current, rows)
+            features = self.features[current]
+            inner = features != LEAF
+            rows, current, features = rows[inner], current[inner], features[inner]
+            codes = queries[rows, features].astype(np.intp)
+            known = codes != MISSING
+            unseen[rows[~known]] = True
+            rows, current, codes = rows[known], current[known], codes[known]
+            nodes[rows] = self.children[self.children_start[current] + codes]
+        return nodes, unseen
+
+    def majority_labels(self, matrix, labels, count, weights=None):
+        """
+        The majority label of the train examples reaching every node, a tie
+        goes to the first label
+        :param matrix: the encoded train examples
+        :param labels: their label codes
+        :param count: number of labels
+        :param weights: the number of copies of every example, if not one
+        :return: array of label codes
+        """
+        votes = np.zeros((len(self.features), count), dtype=np.int64)
+
+        def visit(nodes, rows):
+            np.add.at(votes, (nodes, labels[rows].astype(np.intp)), 1 if weights is None else weights[rows])
+        self.walk(matrix, visit)
+        return np.argmax(votes, axis=1).astype(np.int32)
+
+    def predict_codes(self, queries):
+        """
+        Predicts a matrix of encoded queries, a query with a value never
+        seen at a node gets the fallback label of that node
+        :param queries: 2d array of encoded queries
+        :return: array of label codes
+        """
+        nodes, unseen = self.walk(queries)
+        return np.where(unseen, self.fallbacks[nodes], self.labels[nodes])
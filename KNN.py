@@ -1,57 +1,317 @@
+import numpy as np
+from Dataset import as_dataset, encode_query
+from WeightedDataset import WeightedDataset
+from BitIndex import BitIndex
+from BKTree import BKTree
+from LSHIndex import LSHIndex
+from parallel import run_shared, worker_count
+from persistence import write_arrays, read_arrays, dataset_meta, dataset_from
+from profiler import count, phase
+
+TILE_BYTES = 32 * 1024 * 1024  # memory budget of one block of distances
+
+
 class KNN:
-    def __init__(self, train_set, y_hat, k):
+    def __init__(self, train_set, y_hat=None, k=5, tile_rows=None, index=None):
         """
         The initialization of knn
-        :param train_set: the train set
-        :param y_hat: the y hat set
+        :param train_set: the train set, a Dataset or a WeightedDataset, whose
+        distinct rows are compared once
+        :param y_hat: the y hat set, unused for a Dataset
         :param k: the k neighbors
+        :param tile_rows: number of queries per block of distances, if None
+        it is derived from TILE_BYTES
+        :param index: None for one hot matrix products, 'bits' for a BitIndex,
+        'tree' for a BKTree, 'lsh' for an approximate LSHIndex, or an index object
         """
-        self.train_set = train_set.copy()
-        self.y_hat = y_hat
+        self.weighted = None
+        if isinstance(train_set, WeightedDataset):
+            self.weighted = train_set
+            train_set = train_set.dataset
+        self.dataset = as_dataset(None, train_set, y_hat)
+        self.train_set = self.dataset.matrix
+        self.y_hat = self.dataset.labels
         self.k = k
+        self.tile_rows = tile_rows
+        self.index_name = index if isinstance(index, str) else None
+        self.one_hot = None
+        self.index = None
+        with phase('KNN.train'):
+            self.build_index(index)
+
+    def build_index(self, index):
+        """
+        Builds the index of the train set
+        :param index: the index argument of __init__
+        :return: nothing
+        """
+        if index == 'bits':
+            self.index = BitIndex(self.dataset)
+        elif index == 'tree':
+            self.index = BKTree(self.dataset)
+        elif index == 'lsh':
+            self.index = LSHIndex(self.dataset)
+        elif index is not None and not isinstance(index, str):
+            self.index = index
+        elif index is None:
+            self.one_hot = self.dataset.one_hot(self.train_set, np.float32)
+        else:
+            raise ValueError(index)
+        if self.weighted is not None and hasattr(self.index, 'neighbors'):
+            raise ValueError('a WeightedDataset needs an index of distances, not %s' % index)
 
-    def hamming_distance(self, str1, str2):
+    def save(self, path):
         """
-        The function computes and returns the hamming distance between
-        two strings
-        :param str1: first string
-        :param str2: second string
-        :return: hamming distance
+        Saves the model in the binary format of persistence, the encoded
+        train set (with all the copies of a WeightedDataset)
+        :param path: the file
+        :return: nothing
         """
-        return sum(1 for (a, b) in zip(str1, str2) if a != b)
+        dataset = self.dataset if self.weighted is None else self.weighted.expand()
+        meta = dataset_meta(dataset)
+        meta.update({'k': self.k, 'tile_rows': self.tile_rows, 'index': self.index_name})
+        write_arrays(path, 'KNN', meta, {'matrix': dataset.matrix, 'labels': dataset.labels})
 
-    def predict(self,to_predict):
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model of save, the train set is memory mapped
+        :param path: the file
+        :return: the model
+        """
+        meta, arrays = read_arrays(path, 'KNN')
+        dataset = dataset_from(meta, arrays['matrix'], arrays['labels'])
+        return cls(dataset, k=meta['k'], tile_rows=meta['tile_rows'], index=meta['index'])
+
+    def predict(self, to_predict, workers=1):
+        """
+        The function predicts the tags
+        :param to_predict: an example, a list of examples or a Dataset
+        :param workers: number of processes sharing the queries, None for
+        all the cores. The workers are forked, so the train set is not copied
+        :return: the predictions
+        """
+        queries, single = encode_query(self.dataset, to_predict)
+        if single:
+            return self.predict_encoded(queries)[0]
+        workers = worker_count(workers)
+        if workers == 1 or len(queries) < 2:
+            return self.predict_encoded(queries)
+        size = -(-len(queries) // workers)
+        shards = [(start, start + size) for start in range(0, len(queries), size)]
         predictions = []
-        if all(isinstance(i, list) for i in to_predict):
-            for item in to_predict:
-                predictions.append(self.find_tag(item))
+        for shard in run_shared(predict_shard, (self, queries), shards, workers):
+            predictions.extend(shard)
+        return predictions
+
+    def predict_encoded(self, queries):
+        """
+        Predicts the tags of encoded queries in this process
+        :param queries: 2d array of encoded queries
+        :return: the predictions
+        """
+        with phase('KNN.predict'):
+            count('KNN.predictions', len(queries))
+            if len(queries) == 1 and self.index is None and self.weighted is None:
+                return [self.find_tag(queries[0])]
+            predictions = []
+            if self.weighted is not None:
+                for start, distances in self.distance_blocks(queries):
+                    predictions.extend(self.vote_counts(self.weighted_votes(distances, self.k)))
+                return predictions
+            for neighbors in self.neighbor_blocks(queries, self.k):
+                predictions.extend(self.vote_block(neighbors))
             return predictions
-        else:
-            prediction = self.find_tag(to_predict)
-            return prediction
+
+    def neighbor_blocks(self, queries, k):
+        """
+        The k nearest neighbors of the queries, a block of queries at a time
+        :param queries: 2d array of encoded queries
+        :param k: number of neighbors
+        :return: generator of 2d arrays, the neighbors of each query nearest first
+        """
+        if hasattr(self.index, 'neighbors'):
+            yield np.array(self.index.neighbors(queries, k), dtype=np.intp).reshape(len(queries), -1)
+            return
+        for start, distances in self.distance_blocks(queries):
+            yield self.nearest(distances, k)
+
+    def sweep(self, to_predict, ks):
+        """
+        Predicts with every k at once, the neighbors are found a single
+        time for the largest k and every smaller k votes on a prefix of them
+        :param to_predict: a list of examples or a Dataset
+        :param ks: the k values
+        :return: dictionary of k to the predictions
+        """
+        queries, single = encode_query(self.dataset, to_predict)
+        predictions = {k: [] for k in ks}
+        if self.weighted is not None:
+            for start, distances in self.distance_blocks(queries):
+                for k in ks:
+                    predictions[k].extend(self.vote_counts(self.weighted_votes(distances, k)))
+            return predictions
+        for neighbors in self.neighbor_blocks(queries, max(ks)):
+            for k in ks:
+                predictions[k].extend(self.vote_block(neighbors[:, :k]))
+        return predictions
+
+    def sweep_test(self, test_set, y_hat_test_set, ks):
+        """
+        Given a test set and it's tags, computes the acc of every k
+        :param test_set: the test set
+        :param y_hat_test_set: the tags
+        :param ks: the k values
+        :return: dictionary of k to the acc
+        """
+        accuracies = {}
+        for k, predictions in self.sweep(test_set, ks).items():
+            acc = sum(1 for tag, real in zip(predictions, y_hat_test_set) if tag == real)
+            accuracies[k] = self.truncate_number(acc / len(y_hat_test_set), 2)
+        return accuracies
+
+    def recall(self, to_predict):
+        """
+        The recall of an approximate index against the exact neighbors
+        :param to_predict: a list of examples or a Dataset
+        :return: the recall
+        """
+        queries, single = encode_query(self.dataset, to_predict)
+        return self.index.recall(queries, self.k)
+
+    def tile_size(self):
+        """
+        :return: the number of queries in one block of distances
+        """
+        if self.tile_rows:
+            return self.tile_rows
+        if self.index is not None:
+            return max(1, TILE_BYTES // max(1, self.index.query_bytes()))
+        return max(1, TILE_BYTES // (4 * max(1, len(self.train_set))))
+
+    def distance_blocks(self, queries):
+        """
+        Computes the hamming distances of the queries to all the train set,
+        a block of queries at a time. The number of equal values is the
+        product of the one hot encodings, so a block is one matrix product
+        (or xor and popcount with a BitIndex)
+        :param queries: 2d array of encoded queries
+        :return: generator of (first query index, distances block)
+        """
+        width = self.train_set.shape[1]
+        tile = self.tile_size()
+        for start in range(0, len(queries), tile):
+            count('KNN.distance_computations', len(queries[start:start + tile]) * len(self.train_set))
+            if self.index is not None:
+                yield start, self.index.distances(queries[start:start + tile])
+                continue
+            block = self.dataset.one_hot(queries[start:start + tile], np.float32)
+            matches = block @ self.one_hot.T
+            yield start, width - matches.astype(np.int32)
 
     def find_tag(self, to_predict):
         """
-        The function preficts the tag given an item in test set
-        :param test_set: given test set
-        :return: predictions
+        The function preficts the tag given an encoded item in test set
+        :param to_predict: the encoded item
+        :return: the tag
         """
-        predictions = []
-        distances = []
-        neighbors = []
-        yes_no_dict = {"yes": 0, "no": 0}
-        y_hat_index = 0
-        for example in self.train_set:
-            distance = self.hamming_distance(to_predict, example)
-            distances.append((example, self.y_hat[y_hat_index], distance))
-            y_hat_index += 1
-        distances.sort(key=lambda value: value[2])
-        for i in range(self.k):
-            neighbors.append(distances[i])
-        for neighbor in neighbors:
-            yes_no_dict[neighbor[1]] += 1
-        max_value = max(yes_no_dict, key=yes_no_dict.get)
-        return max_value
+        distances = np.count_nonzero(self.train_set != to_predict, axis=1)
+        count('KNN.distance_computations', len(distances))
+        neighbors = self.nearest(distances[np.newaxis, :], self.k)[0]
+        return self.vote(neighbors)
+
+    def nearest(self, distances, k):
+        """
+        Selects the k nearest train examples of each query without sorting
+        all the distances. A tie in distance goes to the earlier example
+        in the train set, so the result equals a stable sort
+        :param distances: 2d array, the distances of each query to the train set
+        :param k: number of neighbors
+        :return: 2d array of the neighbors indices, nearest first
+        """
+        length = distances.shape[1]
+        keys = distances.astype(np.int64) * length + np.arange(length)
+        if k < length:
+            keys = np.take_along_axis(keys, np.argpartition(keys, k - 1, axis=1)[:, :k], axis=1)
+        keys.sort(axis=1)
+        return keys % length
+
+    def vote(self, neighbors):
+        """
+        The majority tag of the neighbors, a tie goes to the last label
+        (like 'yes' over 'no')
+        :param neighbors: indices of the neighbors in the train set
+        :return: the tag
+        """
+        votes = np.bincount(self.y_hat[neighbors], minlength=len(self.dataset.label_vocabulary))
+        code = len(votes) - 1 - np.argmax(votes[::-1])
+        return self.dataset.label_vocabulary[code]
+
+    def vote_block(self, neighbors):
+        """
+        The vote of each row of a block of neighbors
+        :param neighbors: 2d array, the neighbors indices of each query
+        :return: the tags
+        """
+        labels = len(self.dataset.label_vocabulary)
+        tags = self.y_hat[neighbors]
+        votes = np.stack([np.count_nonzero(tags == code, axis=1) for code in range(labels)], axis=1)
+        return self.vote_counts(votes)
+
+    def vote_counts(self, votes):
+        """
+        The tag with the most votes of each query, a tie goes to the last label
+        :param votes: 2d array, the votes of each query for each label code
+        :return: the tags
+        """
+        labels = votes.shape[1]
+        codes = labels - 1 - np.argmax(votes[:, ::-1], axis=1)
+        return self.dataset.decode_labels(codes)
+
+    def weighted_votes(self, distances, k):
+        """
+        The votes of the k nearest copies of a WeightedDataset, the same as
+        the votes of the k nearest rows of the whole dataset. A distinct row
+        stands for all its copies, its first copy is the first in the order
+        of the rows, so the k nearest distinct rows cover the k nearest
+        copies. They are all taken up to the distance D of the k-th copy,
+        and at D the copies with the lowest indices fill the rest
+        :param distances: 2d array, the distances of each query to the distinct rows
+        :param k: number of neighbors
+        :return: 2d array, the votes of each query for each label code
+        """
+        weighted = self.weighted
+        k = min(k, len(weighted))
+        rows = self.nearest(distances, min(k, distances.shape[1]))
+        near = np.take_along_axis(distances, rows, axis=1)
+        sizes = weighted.sizes[rows]
+        boundary = np.argmax(np.cumsum(sizes, axis=1) >= k, axis=1)
+        limit = near[np.arange(len(near)), boundary][:, np.newaxis]
+        below = near < limit
+        votes = (weighted.counts[rows] * below[:, :, np.newaxis]).sum(axis=1)
+        missing = k - (sizes * below).sum(axis=1)
+        # the first k copies of every distinct row at D, by index
+        steps = np.arange(k)
+        positions = weighted.copy_start[rows][:, :, np.newaxis] + steps
+        valid = (near == limit)[:, :, np.newaxis] & (steps < sizes[:, :, np.newaxis])
+        positions = np.where(valid, positions, 0)
+        indices = np.where(valid, weighted.copies[positions], len(weighted)).reshape(len(rows), -1)
+        tags = weighted.copy_labels[positions].reshape(len(rows), -1)
+        order = np.argsort(indices, axis=1, kind='stable')
+        taken = np.arange(order.shape[1]) < missing[:, np.newaxis]
+        tags = np.take_along_axis(tags, order, axis=1)
+        for code in range(votes.shape[1]):
+            votes[:, code] += np.count_nonzero(taken & (tags == code), axis=1)
+        return votes
+
+    def predict_iter(self, batches):
+        """
+        Predicts a stream of batches, like the chunks of utils.dataset_chunks
+        :param batches: iterable of Datasets or lists of examples
+        :return: generator of the predictions of every batch
+        """
+        for batch in batches:
+            yield self.predict(batch)
 
     def test(self, test_set, y_hat_test_set):
         """
@@ -66,6 +326,7 @@ class KNN:
         for tag in predictions:
             if tag == y_hat_test_set[index]:
                 acc += 1
+            index += 1
         acc = acc / len(y_hat_test_set)
         acc = self.truncate_number(acc, 2)
         return acc
@@ -83,3 +344,15 @@ class KNN:
         if len(k) == 3:
             number += 0.01
         return number
+
+
+def predict_shard(shared, shard):
+    """
+    Predicts a shard of the queries in a worker of KNN.predict
+    :param shared: the model and all the encoded queries
+    :param shard: (start, end) of the shard
+    :return: the predictions of the shard
+    """
+    model, queries = shared
+    start, end = shard
+    return model.predict_encoded(queries[start:end])
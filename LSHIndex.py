@@ -0,0 +1,88 @@
+import numpy as np
+from profiler import count
+
+
+class LSHIndex:
+    def __init__(self, dataset, tables=10, subset=None, seed=0):
+        """
+        Approximate nearest neighbors by bit sampling locality sensitive
+        hashing, every table puts the train examples in buckets keyed by
+        their values on a random subset of the features
+        :param dataset: the train Dataset
+        :param tables: the number of tables
+        :param subset: the number of features of a key, a third of the features if None
+        :param seed: seed of the random subsets
+        """
+        self.dataset = dataset
+        width = dataset.matrix.shape[1]
+        if subset is None:
+            subset = max(1, width // 3)
+        self.subset = min(subset, width)
+        random = np.random.default_rng(seed)
+        self.columns = [np.sort(random.choice(width, self.subset, replace=False)) for _ in range(tables)]
+        self.buckets = [self.build_table(columns) for columns in self.columns]
+        self.candidates = []
+
+    def build_table(self, columns):
+        """
+        :param columns: the features of the key
+        :return: dictionary of key to the indices of the train examples
+        """
+        keys = np.ascontiguousarray(self.dataset.matrix[:, columns])
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        bounds = np.searchsorted(inverse.reshape(-1)[order], np.arange(len(unique) + 1))
+        return {unique[i].tobytes(): order[bounds[i]:bounds[i + 1]] for i in range(len(unique))}
+
+    def candidates_of(self, query):
+        """
+        :param query: the encoded query
+        :return: the indices of the train examples sharing a bucket with the query
+        """
+        found = [table.get(query[columns].tobytes()) for columns, table in zip(self.columns, self.buckets)]
+        found = [indices for indices in found if indices is not None]
+        if not found:
+            return np.zeros(0, dtype=np.intp)
+        return np.unique(np.concatenate(found))
+
+    def neighbors(self, queries, k):
+        """
+        The approximate k nearest neighbors of every query, ranked by the
+        exact distance among the candidates. When there are less than k
+        candidates, the whole train set is scanned. The number of candidates
+        of each query is kept in self.candidates
+        :param queries: 2d array of encoded queries
+        :param k: number of neighbors
+        :return: list of neighbors index arrays
+        """
+        result = []
+        self.candidates = []
+        matrix = self.dataset.matrix
+        for query in queries:
+            candidates = self.candidates_of(query)
+            if len(candidates) < k:
+                candidates = np.arange(len(matrix))
+            self.candidates.append(len(candidates))
+            distances = np.count_nonzero(matrix[candidates] != query, axis=1)
+            order = np.lexsort((candidates, distances))[:k]
+            result.append(candidates[order])
+        count('KNN.distance_computations', sum(self.candidates))
+        return result
+
+    def recall(self, queries, k):
+        """
+        Compares with the exact neighbors, a hit is an approximate neighbor
+        that is as near as the exact k-th neighbor
+        :param queries: 2d array of encoded queries
+        :param k: number of neighbors
+        :return: the fraction of hits
+        """
+        hits = 0
+        total = 0
+        matrix = self.dataset.matrix
+        for query, neighbors in zip(queries, self.neighbors(queries, k)):
+            distances = np.count_nonzero(matrix != query, axis=1)
+            kth = np.partition(distances, min(k, len(distances)) - 1)[min(k, len(distances)) - 1]
+            hits += np.count_nonzero(distances[neighbors] <= kth)
+            total += min(k, len(distances))
+        return hits / total if total else 1.0
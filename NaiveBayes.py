@@ -1,111 +1,222 @@
-import sys
+import copy
+import numpy as np
+from Dataset import as_dataset, encode_query, MISSING
+from WeightedDataset import WeightedDataset
+from persistence import write_arrays, read_arrays, dataset_meta, dataset_from
+from profiler import count, phase
 
 
 class NaiveBayes:
-    def __init__(self, given_features, train, y_hat):
-        """
-        Initialization of the NaiveBayes model
-        :param given_features: features
-        :param train: The train set
-        :param y_hat: The y hats
-        """
-        self.features = given_features.copy()
-        del self.features[-1]
-        self.train_set = train.copy()
-        self.y_hat = y_hat
-        self.total = len(self.y_hat)
-        self.yes, self.no = self.count_yes_no()
-        self.yes_probability = self.yes / (self.yes + self.no)
-        self.no_probability = self.no / (self.yes + self.no)
-        self.likelihood_table = self.create_likelihood_table()
-
-    def create_frequency_table(self):
-        """
-        Creating the frequency table of each feature
-        :return: the frequency table
-        """
-        table = {}
-        feature_index = 0
-        for feature in self.features:
-            table[feature] = {}
-            for example, tag in zip(self.train_set, self.y_hat):
-                att = example[feature_index]
-                if att in table[feature]:
-                    table[feature][att][tag] += 1
-                else:
-                    table[feature][att] = {'yes': 0, 'no': 0}
-                    table[feature][att][tag] += 1
-            feature_index += 1
-        return table
+    def __init__(self, given_features, train=None, y_hat=None, alpha=1):
+        """
+        Initialization of the NaiveBayes model, only the counts of the
+        train set are kept
+        :param given_features: features, a Dataset or a WeightedDataset
+        :param train: The train set, unused for a Dataset
+        :param y_hat: The y hats, unused for a Dataset
+        :param alpha: the additive (Laplace) smoothing of the counts
+        """
+        weights = None
+        if isinstance(given_features, WeightedDataset):
+            dataset, weights = given_features.pairs()
+        else:
+            dataset = as_dataset(given_features, train if train is not None else given_features, y_hat)
+        self.dataset = dataset.empty()
+        self.features = self.dataset.attributes()
+        self.alpha = alpha
+        self.labels = len(self.dataset.label_vocabulary)
+        self.cardinalities = np.array(self.dataset.cardinalities(), dtype=np.intp)
+        # every feature has a row per value and a last row for unseen values
+        self.offsets = np.concatenate(([0], np.cumsum(self.cardinalities + 1)[:-1])).astype(np.intp)
+        with phase('NaiveBayes.train'):
+            self.class_counts, self.frequency_table = self.create_frequency_table(dataset.matrix, dataset.labels,
+                                                                                  weights)
+        self.total = int(self.class_counts.sum())
+        self.likelihood_table = None
 
-    def create_likelihood_table(self):
+    def save(self, path):
+        """
+        Saves the model in the binary format of persistence, the count arrays
+        :param path: the file
+        :return: nothing
+        """
+        meta = dataset_meta(self.dataset)
+        meta['alpha'] = self.alpha
+        arrays = {'matrix': self.dataset.matrix, 'labels': self.dataset.labels,
+                  'class_counts': self.class_counts, 'frequency_table': self.frequency_table}
+        write_arrays(path, 'NaiveBayes', meta, arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model of save, the counts are memory mapped
+        :param path: the file
+        :return: the model
+        """
+        meta, arrays = read_arrays(path, 'NaiveBayes')
+        model = cls(dataset_from(meta, arrays['matrix'], arrays['labels']), alpha=meta['alpha'])
+        model.class_counts = arrays['class_counts']
+        model.frequency_table = arrays['frequency_table']
+        model.total = int(model.class_counts.sum())
+        return model
+
+    def create_frequency_table(self, matrix, labels, weights=None):
+        """
+        Creating the frequency table of all the features, a row per
+        (feature, value) starting at the feature offset, a column per label.
+        Values outside the vocabulary are counted in the unseen row
+        :param matrix: 2d array of encoded examples
+        :param labels: array of label codes
+        :param weights: the number of copies of every example, if not one
+        :return: the counts of the labels, and the frequency table
+        """
+        if np.any(labels == MISSING):
+            raise ValueError('unknown label')
+        labels = labels.astype(np.intp)
+        rows = int(self.offsets[-1] + self.cardinalities[-1] + 1) if len(self.offsets) else 0
+        codes = matrix.astype(np.intp)
+        codes = np.where(codes == MISSING, self.cardinalities, codes) + self.offsets
+        cells = (codes * self.labels + labels[:, np.newaxis]).ravel()
+        count('NaiveBayes.rows_scanned', len(matrix))
+        if weights is not None:
+            cell_weights = np.repeat(weights, matrix.shape[1])
+            table = np.bincount(cells, cell_weights, minlength=rows * self.labels).astype(np.int64)
+            class_counts = np.bincount(labels, weights, minlength=self.labels).astype(np.int64)
+            return class_counts, table.reshape(rows, self.labels)
+        table = np.bincount(cells, minlength=rows * self.labels).reshape(rows, self.labels)
+        return np.bincount(labels, minlength=self.labels), table
+
+    def partial_fit(self, train, y_hat=None):
+        """
+        Adds a batch of examples to the counts, the likelihoods are
+        computed again on the next prediction
+        :param train: a Dataset or a list of examples, encoded with the
+        vocabularies of this model
+        :param y_hat: the tags, unused for a Dataset
+        :return: self
+        """
+        batch = as_dataset(None, train, y_hat, self.dataset).recode(self.dataset)
+        class_counts, frequency_table = self.create_frequency_table(batch.matrix, batch.labels)
+        self.add_counts(class_counts, frequency_table)
+        return self
+
+    def get_counts(self):
+        """
+        :return: the count state, the counts of the labels and the frequency table
+        """
+        return self.class_counts, self.frequency_table
+
+    def merge(self, other):
+        """
+        Adds the counts of a model trained on other examples with the same
+        vocabularies, like a shard trained in another process
+        :param other: a NaiveBayes model
+        :return: self
+        """
+        self.check_compatible(other)
+        self.add_counts(*other.get_counts())
+        return self
+
+    def subtract(self, other):
+        """
+        Removes the counts of a model trained on a part of the examples of this one
+        :param other: a NaiveBayes model
+        :return: self
+        """
+        self.check_compatible(other)
+        class_counts, frequency_table = other.get_counts()
+        if np.any(class_counts > self.class_counts) or np.any(frequency_table > self.frequency_table):
+            raise ValueError('subtracting more examples than were counted')
+        self.add_counts(-class_counts, -frequency_table)
+        return self
+
+    def copy(self):
         """
-        Creating the likelihood table, for each feature
-        :return:
+        :return: a model with the same counts, the counts of one can change
+        without changing the other
         """
-        frequency_table = self.create_frequency_table()
-        likelihood_table = {}
-        for item in frequency_table:
-            likelihood_table[item] = {}
-            table = frequency_table[item]
-            for att in table:
-                p_att_yes = (table[att]['yes'] / self.total) / self.yes_probability
-                p_att_no = (table[att]['no'] / self.total) / self.no_probability
-                likelihood_table[item][att] = {'yes': p_att_yes, 'no': p_att_no}
-        return likelihood_table
+        return copy.copy(self)
+
+    def check_compatible(self, other):
+        """
+        Raises ValueError if the models do not count the same values
+        :param other: a NaiveBayes model
+        :return: nothing
+        """
+        same = other.dataset.vocabularies == self.dataset.vocabularies
+        if not same or other.dataset.label_vocabulary != self.dataset.label_vocabulary:
+            raise ValueError('the models have different vocabularies')
+
+    def add_counts(self, class_counts, frequency_table):
+        """
+        Adds counts to the state of the model
+        :param class_counts: the counts of the labels
+        :param frequency_table: the frequency table
+        :return: nothing
+        """
+        self.class_counts = self.class_counts + class_counts
+        self.frequency_table = self.frequency_table + frequency_table
+        self.total = int(self.class_counts.sum())
+        self.likelihood_table = None
+
+    def create_likelihood_table(self):
+        """
+        Creating the likelihood table, log P(value | label) of every row of
+        the frequency table, smoothed so that unseen values (the last row of
+        every feature) do not zero the probability
+        :return: the log likelihood table
+        """
+        values = np.repeat(self.cardinalities + 1, self.cardinalities + 1)[:, np.newaxis]
+        with np.errstate(divide='ignore'):
+            numerator = np.log(self.frequency_table + self.alpha)
+            denominator = np.log(self.class_counts[np.newaxis, :] + self.alpha * values)
+            self.log_prior = np.log(self.class_counts / max(1, self.class_counts.sum()))
+        return numerator - denominator
 
     def predict(self, to_predict):
         """
         The function predicts the tags
-        :param to_predict: the test
+        :param to_predict: an example, a list of examples or a Dataset
         :return: the predictions
         """
-        predictions = []
-        if all(isinstance(i, list) for i in to_predict):
-            for item in to_predict:
-                predictions.append(self.find_tag(item))
-            return predictions
-        else:
-            prediction = self.find_tag(to_predict)
-            return prediction
+        queries, single = encode_query(self.dataset, to_predict)
+        predictions = self.dataset.decode_labels(self.predict_codes(queries))
+        if single:
+            return predictions[0]
+        return predictions
+
+    def predict_codes(self, queries):
+        """
+        Predicts a matrix of encoded queries, the log likelihoods of the
+        values are gathered from the table and summed for each label
+        :param queries: 2d array of encoded queries
+        :return: array of label codes
+        """
+        with phase('NaiveBayes.predict'):
+            if self.likelihood_table is None:
+                self.likelihood_table = self.create_likelihood_table()
+            codes = queries.astype(np.intp)
+            rows = np.where(codes == MISSING, self.cardinalities, codes) + self.offsets
+            scores = self.likelihood_table[rows].sum(axis=1) + self.log_prior
+            count('NaiveBayes.predictions', len(queries))
+            return np.argmax(scores, axis=1)
 
     def find_tag(self, item):
         """
         The function finds the tag based on probability
-        :param item: the item we want to tag
+        :param item: the encoded item we want to tag
         :return: prediction (tag)
         """
-        index = 0
-        yes = 1
-        no = 1
-        for ex in item:
-            current_feature = self.features[index]
-            yes *= self.likelihood_table[current_feature][ex]['yes']
-            no *= self.likelihood_table[current_feature][ex]['no']
-            index += 1
-        try:
-            p_yes = (self.yes_probability * yes) / ((self.yes_probability * yes) + (self.no_probability * no))
-            p_no = (self.no_probability * no) / ((self.yes_probability * yes) + (self.no_probability * no))
-        except:
-            sys.exit(-1)
-        if p_yes > p_no:
-            return 'yes'
-        else:
-            return 'no'
+        return self.dataset.label_vocabulary[self.predict_codes(item[np.newaxis, :])[0]]
 
-    def count_yes_no(self):
+    def predict_iter(self, batches):
         """
-        The function counts the number of yes and no
-        :return: yes,no number
+        Predicts a stream of batches, like the chunks of utils.dataset_chunks
+        :param batches: iterable of Datasets or lists of examples
+        :return: generator of the predictions of every batch
         """
-        yes_counter = 0
-        no_counter = 0
-        for tag in self.y_hat:
-            if tag == 'yes':
-                yes_counter += 1
-            else:
-                no_counter += 1
-        return yes_counter, no_counter
+        for batch in batches:
+            yield self.predict(batch)
 
     def test(self, test_set, y_hat_test):
         """
@@ -120,6 +231,7 @@ class NaiveBayes:
         for tag in predictions:
             if tag == y_hat_test[index]:
                 acc += 1
+            index += 1
         acc = acc / len(y_hat_test)
         acc = self.truncate_number(acc, 2)
         return acc
@@ -1,4 +1,12 @@
+import sys
+from types import MappingProxyType
+
+NO_CHILDRENS = MappingProxyType({})  # shared by all the nodes without childrens
+
+
 class Node:
+    __slots__ = ('childrens', 'value', 'default', 'leaf', 'index', 'is_root')
+
     def __init__(self, value=None, default=None, is_leaf=None, index=None):
         """
         Initialization of node class
@@ -7,13 +15,30 @@ class Node:
         :param is_leaf: is a leaf
         :param index: index as a feature
         """
-        self.childrens = {}
+        self.childrens = NO_CHILDRENS
         self.value = value
         self.default = default
         self.leaf = is_leaf
         self.index = index
         self.is_root = False
 
+    def __getstate__(self):
+        """
+        The state for pickle, the shared empty childrens can not be pickled
+        :return: the values of the slots
+        """
+        childrens = None if self.childrens is NO_CHILDRENS else self.childrens
+        return childrens, self.value, self.default, self.leaf, self.index, self.is_root
+
+    def __setstate__(self, state):
+        """
+        Restores a state of __getstate__
+        :param state: the values of the slots
+        :return: nothing
+        """
+        childrens, self.value, self.default, self.leaf, self.index, self.is_root = state
+        self.childrens = NO_CHILDRENS if childrens is None else childrens
+
     def set_is_root(self):
         """
         Set the node to be root
@@ -34,6 +59,8 @@ class Node:
         :param child: the name of the child
         :return:
         """
+        if self.childrens is NO_CHILDRENS:
+            self.childrens = {}
         self.childrens[value] = child
 
     def get_default(self):
@@ -65,3 +92,44 @@ class Node:
         :return: Return all the childrens
         """
         return self.childrens
+
+
+class DictNode:
+    def __init__(self):
+        """
+        The layout of a Node before __slots__, used by memory_report
+        """
+        self.childrens = {}
+        self.value = None
+        self.default = None
+        self.leaf = None
+        self.index = None
+        self.is_root = False
+
+
+def memory_report(root):
+    """
+    Measures the memory of a tree of Node, and of the same tree with a
+    __dict__ and a childrens dictionary on every node
+    :param root: the root of the tree
+    :return: dictionary with the nodes, leaves, bytes and dict_node_bytes
+    """
+    nodes = 0
+    leaves = 0
+    size = 0
+    dict_size = 0
+    empty = DictNode()
+    empty_size = sys.getsizeof(empty) + sys.getsizeof(empty.__dict__)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        childrens = node.get_childrens()
+        size += sys.getsizeof(node)
+        if childrens is not NO_CHILDRENS:
+            size += sys.getsizeof(childrens)
+        else:
+            leaves += 1
+        dict_size += empty_size + sys.getsizeof(dict.fromkeys(childrens))
+        stack.extend(childrens.values())
+    return {'nodes': nodes, 'leaves': leaves, 'bytes': size, 'dict_node_bytes': dict_size}
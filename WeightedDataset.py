@@ -0,0 +1,47 @@
+import numpy as np
+from Dataset import unique_rows
+
+
+class WeightedDataset:
+    def __init__(self, dataset):
+        """
+        A Dataset with its identical rows collapsed, every distinct row is
+        kept once with the number of its copies of each label. The models
+        train on it with the same results as on the whole dataset
+        :param dataset: the Dataset
+        """
+        first, inverse = unique_rows(dataset.matrix)
+        labels = dataset.labels.astype(np.intp)
+        count = len(dataset.label_vocabulary)
+        self.dataset = dataset.take(first)
+        self.labels = dataset.labels
+        self.inverse = inverse
+        self.counts = np.bincount(inverse * count + labels, minlength=len(first) * count).reshape(-1, count)
+        self.sizes = self.counts.sum(axis=1)
+        # the indices of the copies of every distinct row, ascending, from copy_start[row]
+        self.copies = np.argsort(inverse, kind='stable')
+        self.copy_start = np.concatenate(([0], np.cumsum(self.sizes))).astype(np.intp)
+        self.copy_labels = labels[self.copies]
+        # the distinct (row, label) pairs, in the order they first appear
+        keys, pair_first = np.unique(inverse * count + labels, return_index=True)
+        keys = keys[np.argsort(pair_first, kind='stable')]
+        self.pair_rows = keys // count
+        self.pair_labels = keys % count
+        self.pair_weights = self.counts[self.pair_rows, self.pair_labels]
+
+    def pairs(self):
+        """
+        :return: a Dataset with a row per distinct (row, label) pair, in the
+        order they first appear, and the number of copies of every pair
+        """
+        matrix = self.dataset.matrix[self.pair_rows]
+        return self.dataset.like(matrix, self.pair_labels.astype(self.labels.dtype)), self.pair_weights
+
+    def expand(self):
+        """
+        :return: the whole Dataset, every row with its copies
+        """
+        return self.dataset.like(self.dataset.matrix[self.inverse], self.labels)
+
+    def __len__(self):
+        return len(self.inverse)
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import tempfile
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from Dataset import Dataset
+from KNN import KNN
+from NaiveBayes import NaiveBayes
+from DecisionTree import DecisionTree
+from utils import k_fold_cross_validation, dataset_reader
+
+MODELS = {'KNN': KNN, 'NaiveBayes': NaiveBayes, 'DecisionTree': DecisionTree}
+WORKLOAD = ('features', 'cardinality', 'noise', 'folds', 'seed')  # arguments that change what is measured
+BASELINE = 'bench_baseline.json'  # the stored baseline, made with the default arguments
+VALUES = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def generate_dataset(rows, features=22, cardinality=6, noise=0.05, seed=0):
+    """
+    Generates a mushroom like categorical dataset, the tag is decided by
+    the values of a few hidden features and then flipped with probability noise
+    :param rows: number of examples
+    :param features: number of features
+    :param cardinality: number of values of every feature
+    :param noise: probability of a wrong tag
+    :param seed: seed of the generator
+    :return: the Dataset
+    """
+    random = np.random.default_rng(seed)
+    cardinality = min(cardinality, len(VALUES))
+    matrix = random.integers(0, cardinality, size=(rows, features)).astype(np.int8)
+    hidden = random.choice(features, size=min(3, features), replace=False)
+    weights = random.normal(size=(len(hidden), cardinality))
+    score = sum(weights[i][matrix[:, column]] for i, column in enumerate(hidden))
+    labels = (score > np.median(score)).astype(np.int8)
+    flip = random.random(rows) < noise
+    labels[flip] = 1 - labels[flip]
+    names = ['feature_%d' % i for i in range(features)] + ['can_eat']
+    vocabularies = [list(VALUES[:cardinality]) for _ in range(features)]
+    return Dataset(names, matrix, labels, vocabularies, ['no', 'yes'])
+
+
+def write_dataset(dataset, path):
+    """
+    Writes a dataset as a tab separated file, like train.txt
+    :param dataset: the Dataset
+    :param path: the file
+    :return: nothing
+    """
+    tags = dataset.decode_labels(dataset.labels)
+    with open(path, 'w') as file:
+        file.write('\t'.join(dataset.features) + '\n')
+        for row, tag in zip(dataset.decode(), tags):
+            file.write('\t'.join(row) + '\t' + tag + '\n')
+
+
+def measure(function, memory=True, repeat=3):
+    """
+    Runs a function, timed without tracing, and again under tracemalloc
+    for its peak memory, since tracing slows the allocations down
+    :param function: function without arguments
+    :param memory: False to skip the memory run
+    :param repeat: number of timed runs, the fastest is kept
+    :return: the result, the seconds and the peak of traced memory in bytes
+    """
+    seconds = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_size(rows, features, cardinality, noise, seed, folds, memory=True, repeat=3):
+    """
+    Times reading, and the training, prediction and cross validation of
+    every model on a generated dataset, the test set is a quarter of the train set
+    :return: list of result records
+    """
+    train = generate_dataset(rows, features, cardinality, noise, seed)
+    test = generate_dataset(max(1, rows // 4), features, cardinality, noise, seed + 1)
+    records = []
+    descriptor, path = tempfile.mkstemp(suffix='.txt')
+    os.close(descriptor)
+    try:
+        write_dataset(train, path)
+        result, seconds, peak = measure(lambda: dataset_reader(path, cache=False), memory, repeat)
+        records.append(record('Dataset', 'read', rows, seconds, peak))
+    finally:
+        os.remove(path)
+    for name, model_class in MODELS.items():
+        model, seconds, peak = measure(lambda: model_class(train), memory, repeat)
+        records.append(record(name, 'train', rows, seconds, peak))
+        predictions, seconds, peak = measure(lambda: model.predict(test), memory, repeat)
+        records.append(record(name, 'predict', len(test), seconds, peak))
+        result, seconds, peak = measure(lambda: k_fold_cross_validation(name, train, folds=folds, seed=seed),
+                                        memory, repeat)
+        records.append(record(name, 'cross_validation', rows, seconds, peak))
+    return records
+
+
+def record(model, phase, rows, seconds, peak):
+    """
+    :return: a result record
+    """
+    return {'model': model, 'phase': phase, 'rows': rows, 'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds else None, 'peak_bytes': peak}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Finds the records that are slower than the same record of the baseline
+    :param results: the records of this run
+    :param baseline: the records of the baseline
+    :param tolerance: allowed slow down, 0.2 is 20% slower
+    :return: list of regression messages
+    """
+    previous = {(entry['model'], entry['phase'], entry['rows']): entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        old = previous.get((entry['model'], entry['phase'], entry['rows']))
+        if old is None:
+            continue
+        for key in ('seconds', 'peak_bytes'):
+            if old[key] and entry[key] is not None and entry[key] > old[key] * (1 + tolerance):
+                regressions.append('%s %s %d rows: %s %.4g -> %.4g' % (entry['model'], entry['phase'], entry['rows'],
+                                                                       key, old[key], entry[key]))
+    return regressions
+
+
+def workload(args):
+    """
+    :param args: the arguments of a run, a dictionary
+    :return: the arguments that change what is measured
+    """
+    return {name: args.get(name) for name in WORKLOAD}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark of the models on generated datasets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000, 16000])
+    parser.add_argument('--features', type=int, default=22)
+    parser.add_argument('--cardinality', type=int, default=6)
+    parser.add_argument('--noise', type=float, default=0.05)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='results file to compare with, like ' + BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every measure, the fastest is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    args = parser.parse_args(argv[1:])
+    results = []
+    for rows in args.sizes:
+        results.extend(bench_size(rows, args.features, args.cardinality, args.noise, args.seed, args.folds,
+                                  not args.no_memory, args.repeat))
+    for entry in results:
+        print('%-12s %-16s %8d rows %9.4fs %12s rows/s %12s bytes' % (
+            entry['model'], entry['phase'], entry['rows'], entry['seconds'],
+            '%.0f' % entry['rows_per_second'] if entry['rows_per_second'] else '-', entry['peak_bytes']))
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'args': vars(args), 'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if workload(baseline['args']) != workload(vars(args)):
+            print('the baseline was run with %s, not %s' % (workload(baseline['args']), workload(vars(args))))
+            return 2
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
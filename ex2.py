@@ -1,15 +1,36 @@
-from utils import train_set_reader, test_set_reader, create_output
+from utils import dataset_reader, create_output
 from DecisionTree import DecisionTree
 from KNN import KNN
+import profiler
 import sys
 
 
 def main(argv):
+    """
+    ex2.py train test [--profile report.json] [--collapse]
+    With --profile the phases are timed and the work is counted, and the
+    report is written as json. With --collapse the models train on the
+    distinct rows of the train set and the number of their copies
+    """
+    argv = list(argv)
+    report = None
+    collapse = '--collapse' in argv
+    if collapse:
+        argv.remove('--collapse')
+    if '--profile' in argv:
+        position = argv.index('--profile')
+        report = argv[position + 1]
+        del argv[position:position + 2]
+        profiler.reset()
+        profiler.enable()
     train = argv[1]
     test = argv[2]
-    features, train_set, y_hat = train_set_reader(train)
-    test_set, y_hat_test = test_set_reader(test)
-    create_output(features, train_set, y_hat, test_set, y_hat_test)
+    train_set = dataset_reader(train)
+    test_set = dataset_reader(test, train_set)
+    create_output(train_set, None, None, test_set, None, collapse=collapse)
+    if report is not None:
+        profiler.enable(False)
+        profiler.write_report(report)
 
 
 
@@ -0,0 +1,73 @@
+import os
+import multiprocessing
+import profiler
+
+shared = None  # the object the workers read, inherited on fork
+
+
+def worker_count(workers):
+    """
+    :param workers: number of workers, None or 0 for all the cores
+    :return: number of workers
+    """
+    if not workers:
+        return os.cpu_count() or 1
+    return workers
+
+
+def set_shared(value):
+    """
+    Initializer of the workers when they can not be forked
+    :param value: the shared object
+    :return: nothing
+    """
+    global shared
+    shared = value
+
+
+def call_shared(task):
+    """
+    Runs a task of run_shared in a worker
+    :param task: (function, argument, True to profile)
+    :return: the result, and the profiler snapshot of the task or None
+    """
+    function, argument, profile = task
+    if profile:
+        profiler.enable()
+        return profiler.collect(function, shared, argument)
+    return function(shared, argument), None
+
+
+def run_shared(function, value, arguments, workers=None):
+    """
+    Runs function(value, argument) for every argument on a process pool.
+    With fork the workers inherit value, so it is never pickled, otherwise
+    it is sent once to every worker. The profiler counts of the workers
+    are added to the ones of this process
+    :param function: a module level function
+    :param value: the shared object, like a model or a Dataset
+    :param arguments: the arguments of the tasks
+    :param workers: number of processes, None for all the cores
+    :return: the results, in the order of arguments
+    """
+    global shared
+    arguments = list(arguments)
+    workers = min(worker_count(workers), max(1, len(arguments)))
+    if workers == 1:
+        return [function(value, argument) for argument in arguments]
+    tasks = [(function, argument, profiler.enabled) for argument in arguments]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        previous = shared
+        shared = value
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.map(call_shared, tasks, chunksize=1)
+        finally:
+            shared = previous
+    else:
+        with multiprocessing.Pool(workers, set_shared, (value,)) as pool:
+            results = pool.map(call_shared, tasks, chunksize=1)
+    for _, snapshot in results:
+        if snapshot is not None:
+            profiler.merge(snapshot)
+    return [result for result, _ in results]
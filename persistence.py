@@ -0,0 +1,114 @@
+import os
+import json
+import struct
+import tempfile
+import numpy as np
+from Dataset import Dataset
+
+MAGIC = b'IAIMODEL'
+FORMAT_VERSION = 1
+ALIGNMENT = 64  # every array starts at a multiple of it
+HEADER = struct.Struct('<8sII')  # magic, version, length of the json metadata
+HEADER_KEYS = ('kind', 'meta', 'arrays')  # the keys of the json metadata
+ARRAY_KEYS = ('dtype', 'shape', 'offset')  # the keys of every array entry
+
+
+def write_arrays(path, kind, meta, arrays):
+    """
+    Writes a binary file: the header, the json metadata, then the raw
+    bytes of every array, aligned so that they can be memory mapped.
+    The file is written aside and then replaces path, so the memory maps
+    of read_arrays on the old file stay valid
+    :param path: the file
+    :param kind: the kind of the content, like the model class name
+    :param meta: dictionary of json values
+    :param arrays: dictionary of name to numpy array
+    :return: nothing
+    """
+    directory = {}
+    offset = 0
+    for name, array in arrays.items():
+        directory[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'kind': kind, 'meta': meta, 'arrays': directory}).encode('utf-8')
+    start = -(-(HEADER.size + len(header)) // ALIGNMENT) * ALIGNMENT
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(header)))
+            file.write(header)
+            for name, array in arrays.items():
+                file.seek(start + directory[name]['offset'])
+                file.write(np.ascontiguousarray(array).tobytes())
+            file.truncate(start + offset)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary, 0o666 & ~umask)  # like open(), mkstemp makes it private
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def read_arrays(path, kind):
+    """
+    Reads a file of write_arrays, the arrays are read only views on a
+    memory map of the file, nothing is parsed or copied. A short or
+    malformed file raises ValueError
+    :param path: the file
+    :param kind: the expected kind
+    :return: the metadata, and dictionary of name to array
+    """
+    with open(path, 'rb') as file:
+        data = file.read(HEADER.size)
+        if len(data) < HEADER.size:
+            raise ValueError('%s is too short for a model file' % path)
+        magic, version, length = HEADER.unpack(data)
+        if magic != MAGIC:
+            raise ValueError('%s is not a model file' % path)
+        if version != FORMAT_VERSION:
+            raise ValueError('%s has format version %d, expected %d' % (path, version, FORMAT_VERSION))
+        data = file.read(length)
+        if len(data) < length:
+            raise ValueError('%s is too short for its header' % path)
+        header = json.loads(data.decode('utf-8'))
+    if not isinstance(header, dict) or any(key not in header for key in HEADER_KEYS):
+        raise ValueError('%s has no %s in its header' % (path, ', '.join(HEADER_KEYS)))
+    if any(not isinstance(entry, dict) or any(key not in entry for key in ARRAY_KEYS)
+           for entry in header['arrays'].values()):
+        raise ValueError('%s has an array without %s' % (path, ', '.join(ARRAY_KEYS)))
+    if header['kind'] != kind:
+        raise ValueError('%s holds a %s, not a %s' % (path, header['kind'], kind))
+    start = -(-(HEADER.size + length) // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    buffer = None
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        if count == 0:
+            arrays[name] = np.zeros(entry['shape'], dtype=dtype)
+            continue
+        if buffer is None:
+            buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        position = start + entry['offset']
+        arrays[name] = buffer[position:position + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+    return header['meta'], arrays
+
+
+def dataset_meta(dataset):
+    """
+    :param dataset: a Dataset
+    :return: the json metadata of its vocabularies
+    """
+    return {'features': dataset.features, 'vocabularies': dataset.vocabularies,
+            'label_vocabulary': dataset.label_vocabulary}
+
+
+def dataset_from(meta, matrix, labels):
+    """
+    :param meta: the metadata of dataset_meta
+    :param matrix: the codes
+    :param labels: the label codes
+    :return: the Dataset
+    """
+    return Dataset(meta['features'], matrix, labels, meta['vocabularies'], meta['label_vocabulary'])
@@ -0,0 +1,131 @@
+import time
+import json
+import contextlib
+
+enabled = False  # set by enable, everything below is a no op while it is False
+counters = {}  # name to count
+timers = {}  # name to [seconds, calls]
+NO_PHASE = contextlib.nullcontext()
+
+
+def enable(value=True):
+    """
+    Turns the instrumentation on or off, the counts are kept
+    :param value: True to count and time
+    :return: nothing
+    """
+    global enabled
+    enabled = value
+
+
+def reset():
+    """
+    Forgets all the counts and times
+    :return: nothing
+    """
+    counters.clear()
+    timers.clear()
+
+
+def count(name, amount=1):
+    """
+    Adds to a counter, like the nodes built or the distances computed.
+    Called once per batch or node, not per value, so it stays cheap
+    :param name: the counter
+    :param amount: how much to add
+    :return: nothing
+    """
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+
+class Timer:
+    def __init__(self, name):
+        """
+        Adds the wall clock time of a with block to a timer
+        :param name: the timer
+        """
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        entry = timers.setdefault(self.name, [0.0, 0])
+        entry[0] += time.perf_counter() - self.start
+        entry[1] += 1
+        return False
+
+
+def phase(name):
+    """
+    Times a phase, used as: with phase('train'): ...
+    Phases may nest, each one has its own total
+    :param name: the timer
+    :return: a context manager, a shared empty one when disabled
+    """
+    if enabled:
+        return Timer(name)
+    return NO_PHASE
+
+
+def snapshot():
+    """
+    :return: a copy of the counts and times
+    """
+    return {'counters': dict(counters), 'timers': {name: list(entry) for name, entry in timers.items()}}
+
+
+def merge(other):
+    """
+    Adds the counts and times of a snapshot, like the one of a worker
+    :param other: a snapshot
+    :return: nothing
+    """
+    for name, amount in other['counters'].items():
+        counters[name] = counters.get(name, 0) + amount
+    for name, (seconds, calls) in other['timers'].items():
+        entry = timers.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+
+def collect(function, *arguments):
+    """
+    Runs a function with empty counts and times, then puts the previous
+    ones back. Used by the workers of parallel.run_shared, which return
+    their counts to be merged in the parent process
+    :param function: the function
+    :param arguments: its arguments
+    :return: the result, and the snapshot of the run
+    """
+    previous = snapshot()
+    reset()
+    try:
+        result = function(*arguments)
+        return result, snapshot()
+    finally:
+        reset()
+        merge(previous)
+
+
+def report():
+    """
+    :return: dictionary of the counters, and of the seconds and calls of
+    every timer. Times of workers are added up, so a parallel phase may
+    take more seconds than the wall clock
+    """
+    phases = {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in sorted(timers.items())}
+    return {'counters': dict(sorted(counters.items())), 'phases': phases}
+
+
+def write_report(path):
+    """
+    Writes the report as json
+    :param path: the file
+    :return: nothing
+    """
+    with open(path, 'w') as file:
+        json.dump(report(), file, indent=2)
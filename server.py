@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import collections
+import socketserver
+import numpy as np
+from concurrent.futures import Future
+from Dataset import encode_query, unique_rows
+from KNN import KNN
+from NaiveBayes import NaiveBayes
+from DecisionTree import DecisionTree
+from parallel import run_shared
+from utils import dataset_reader, train_job
+
+MODELS = {'DecisionTree': DecisionTree, 'KNN': KNN, 'NaiveBayes': NaiveBayes}
+STOP = None  # put in the queue to stop the batcher
+
+
+class Request:
+    def __init__(self, row):
+        """
+        A row waiting to be predicted
+        :param row: the example, a list of values
+        """
+        self.row = row
+        self.arrival = time.perf_counter()
+        self.future = Future()
+
+
+class StatsAnswer(Future):
+    """
+    The answer of a STATS line, resolved by the writer of serve_lines
+    when its turn comes, after the answers of all the lines before it
+    """
+
+
+class PredictionServer:
+    def __init__(self, models, max_batch=256, max_delay=0.005, window=100000):
+        """
+        Predicts rows with trained models. The rows of concurrent requests
+        are coalesced into micro batches: a batch is predicted when it has
+        max_batch rows, or max_delay seconds after its first row arrived
+        :param models: dictionary of name to trained model, with the same vocabularies
+        :param max_batch: the most rows in a batch
+        :param max_delay: the latency budget of the batching, in seconds
+        :param window: number of latest latencies kept for the percentiles
+        """
+        self.models = models
+        reference = next(iter(models.values())).dataset
+        for name, model in models.items():
+            if model.dataset.vocabularies != reference.vocabularies:
+                raise ValueError('%s was trained on other vocabularies' % name)
+        self.dataset = reference
+        self.width = len(reference.vocabularies)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=window)
+        self.completed = 0
+        self.batches = 0
+        self.started = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, row):
+        """
+        Queues a row, called from any thread. A row with one more value
+        than the features (a line of the test file) has its tag dropped
+        :param row: the example, a list of values
+        :return: a Future of the tuple of the tags of every model
+        """
+        if len(row) == self.width + 1:
+            row = row[:-1]
+        if len(row) != self.width:
+            raise ValueError('expected %d values, got %d' % (self.width, len(row)))
+        request = Request(row)
+        self.requests.put(request)
+        return request.future
+
+    def predict(self, row):
+        """
+        :param row: the example, a list of values
+        :return: the tuple of the tags of every model
+        """
+        return self.submit(row).result()
+
+    def run(self):
+        """
+        The batcher thread, waits for a first request then gathers more
+        until the batch is full or the latency budget of the first is
+        spent, the requests already queued are always taken
+        :return: nothing
+        """
+        while True:
+            first = self.requests.get()
+            if first is STOP:
+                return
+            batch = [first]
+            stop = False
+            deadline = first.arrival + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        request = self.requests.get(timeout=timeout)
+                    else:  # the budget is spent, take only what is already waiting
+                        request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is STOP:
+                    stop = True
+                    break
+                batch.append(request)
+            self.process(batch)
+            if stop:
+                return
+
+    def process(self, batch):
+        """
+        Predicts a batch, the rows are encoded once for all the models and
+        identical rows are predicted once
+        :param batch: list of Request
+        :return: nothing
+        """
+        try:
+            queries, single = encode_query(self.dataset, [request.row for request in batch])
+            first, inverse = unique_rows(queries)
+            predictions = [model.predict(queries[first]) for model in self.models.values()]
+            inverse = inverse.tolist()
+        except Exception as error:
+            for request in batch:
+                request.future.set_exception(error)
+            return
+        done = time.perf_counter()
+        with self.lock:
+            if self.started is None:
+                self.started = batch[0].arrival
+            self.batches += 1
+            self.completed += len(batch)
+            self.latencies.extend(done - request.arrival for request in batch)
+        for i, request in enumerate(batch):
+            request.future.set_result(tuple(tags[inverse[i]] for tags in predictions))
+
+    def stats(self):
+        """
+        :return: dictionary of the number of requests and batches, the mean
+        batch size, the p50 and p99 latencies in milliseconds and the
+        throughput in rows per second since the first request
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            completed = self.completed
+            batches = self.batches
+            elapsed = time.perf_counter() - self.started if self.started is not None else 0
+        result = {'requests': completed, 'batches': batches, 'mean_batch': completed / batches if batches else 0,
+                  'p50_ms': None, 'p99_ms': None, 'throughput': completed / elapsed if elapsed else 0}
+        if len(latencies):
+            result['p50_ms'] = float(np.percentile(latencies, 50)) * 1000
+            result['p99_ms'] = float(np.percentile(latencies, 99)) * 1000
+        return result
+
+    def close(self):
+        """
+        Predicts the queued rows and stops the batcher
+        :return: nothing
+        """
+        self.requests.put(STOP)
+        self.thread.join()
+
+
+def serve_lines(server, reader, writer):
+    """
+    The line protocol: every line is an example, tab separated, and the
+    answer is a line of the tags of every model, tab separated, in the
+    order of the lines. Lines are read ahead of the answers, so a client
+    sending many lines fills the batches. The line STATS is answered
+    with the json of server.stats(), taken once all the lines before it
+    are answered, a bad line with ERROR and the reason
+    :param server: the PredictionServer
+    :param reader: text stream of lines
+    :param writer: text stream for the answers
+    :return: nothing
+    """
+    answers = queue.Queue()
+
+    def write():
+        while True:
+            answer = answers.get()
+            if answer is STOP:
+                writer.flush()
+                return
+            if isinstance(answer, StatsAnswer):
+                answer.set_result((json.dumps(server.stats()),))
+            try:
+                line = '\t'.join(answer.result())
+            except Exception as error:
+                line = 'ERROR %s' % error
+            writer.write(line + '\n')
+            if answers.empty():
+                writer.flush()
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    try:
+        for line in reader:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            if line == 'STATS':
+                answer = StatsAnswer()
+            else:
+                try:
+                    answer = server.submit(line.split('\t'))
+                except ValueError as error:
+                    answer = Future()
+                    answer.set_exception(error)
+            answers.put(answer)
+    finally:
+        answers.put(STOP)
+        thread.join()
+
+
+class LineHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        """
+        Serves a connection of the unix socket with the line protocol
+        """
+        with self.request.makefile('r', encoding='utf-8', newline='\n') as reader, \
+                self.request.makefile('w', encoding='utf-8', newline='\n') as writer:
+            serve_lines(self.server.prediction_server, reader, writer)
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def load_models(names, train=None, directory=None, workers=3):
+    """
+    Loads the models saved in directory (as <name>.model), and trains the
+    missing ones on the train file
+    :param names: the names of the models
+    :param train: path of the train file
+    :param directory: directory of saved models, may be None
+    :return: dictionary of name to model, in the order of names
+    """
+    models = {}
+    for name in names:
+        path = os.path.join(directory, name + '.model') if directory else None
+        if path and os.path.exists(path):
+            models[name] = MODELS[name].load(path)
+    missing = [name for name in names if name not in models]
+    if missing:
+        if train is None:
+            raise ValueError('no saved model and no train file for ' + ', '.join(missing))
+        dataset = dataset_reader(train)
+        for name, model in zip(missing, run_shared(train_job, dataset, missing, workers)):
+            models[name] = model
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                model.save(os.path.join(directory, name + '.model'))
+    return {name: models[name] for name in names}
+
+
+def interrupt(signum, frame):
+    """
+    Stops the server on SIGTERM like on ctrl c
+    """
+    raise KeyboardInterrupt
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Prediction server, lines of examples in, lines of tags out')
+    parser.add_argument('--train', help='train file of the models that are not saved')
+    parser.add_argument('--models-dir', help='directory of the saved models, the trained ones are saved there')
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--socket', help='path of a unix socket to listen on, stdin and stdout if not given')
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-delay-ms', type=float, default=5.0)
+    args = parser.parse_args(argv[1:])
+    models = load_models(args.models, args.train, args.models_dir)
+    server = PredictionServer(models, args.max_batch, args.max_delay_ms / 1000)
+    try:
+        if args.socket is None:
+            serve_lines(server, sys.stdin, sys.stdout)
+        else:
+            if os.path.exists(args.socket):
+                os.remove(args.socket)
+            signal.signal(signal.SIGTERM, interrupt)
+            with UnixServer(args.socket, LineHandler) as listener:
+                listener.prediction_server = server
+                try:
+                    listener.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+            os.remove(args.socket)
+    finally:
+        server.close()
+        sys.stderr.write(json.dumps(server.stats()) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
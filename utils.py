@@ -1,8 +1,20 @@
+import os
 import math
-from KNN import KNN
+import random
+import itertools
+import hashlib
+import numpy as np
+from Dataset import Dataset, unique_rows
+from WeightedDataset import WeightedDataset
+from persistence import write_arrays, read_arrays, dataset_meta, dataset_from
+from parallel import run_shared
+from profiler import count, phase
+from KNN import KNN, TILE_BYTES
 from DecisionTree import DecisionTree
 from NaiveBayes import NaiveBayes
 
+CACHE_KEYS = ('size', 'mtime_ns', 'sha256', 'features', 'vocabularies', 'label_vocabulary')  # metadata of a cache
+
 
 def train_set_reader(data):
     """
@@ -21,6 +33,8 @@ def train_set_reader(data):
             del example[-1]
             train_set.append(example)
             y_hat.append(classification)
+    count('bytes_read', os.path.getsize(data))
+    count('rows_read', len(train_set))
     return features, train_set, y_hat
 
 
@@ -39,9 +53,140 @@ def test_set_reader(data):
             del example[-1]
             test_set.append(example)
             y_hat.append(classification)
+    count('bytes_read', os.path.getsize(data))
+    count('rows_read', len(test_set))
     return test_set, y_hat
 
 
+def file_signature(data, content_hash=False):
+    """
+    :param data: path of a file
+    :param content_hash: also hash the content of the file
+    :return: dictionary with the size and mtime, and the sha256 if asked
+    """
+    status = os.stat(data)
+    signature = {'size': status.st_size, 'mtime_ns': status.st_mtime_ns}
+    if content_hash:
+        digest = hashlib.sha256()
+        with open(data, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        signature['sha256'] = digest.hexdigest()
+    return signature
+
+
+def dataset_reader(data, reference=None, cache=True):
+    """
+    Reads a file as an encoded Dataset. The parsed dataset is kept in a
+    binary sidecar file (data + '.cache'), used again while the file has
+    the same size and mtime, or else the same sha256. The sidecar is
+    always replaced whole (see write_arrays), so the datasets mapped from
+    an older one, here or in another process, stay valid
+    :param data: path of the file
+    :param reference: a dataset to take the vocabularies from
+    :param cache: False to always parse the file
+    :return: the dataset
+    """
+    with phase('read'):
+        return read_dataset(data, reference, cache)
+
+
+def read_dataset(data, reference=None, cache=True):
+    """
+    dataset_reader without the timing of the read phase
+    :param data: path of the file
+    :param reference: a dataset to take the vocabularies from
+    :param cache: False to always parse the file
+    :return: the dataset
+    """
+    dataset = None
+    signature = None
+    cache_path = data + '.cache'
+    if cache and os.path.exists(cache_path):
+        try:
+            meta, arrays = read_arrays(cache_path, 'Dataset')
+        except (ValueError, OSError):
+            meta = None
+        if meta is not None and (any(key not in meta for key in CACHE_KEYS) or
+                                 any(name not in arrays for name in ('matrix', 'labels'))):
+            meta = None  # written by another version, stale
+        if meta is not None:
+            signature = file_signature(data)
+            fresh = signature['size'] == meta['size'] and signature['mtime_ns'] == meta['mtime_ns']
+            if fresh:
+                dataset = dataset_from(meta, arrays['matrix'], arrays['labels'])
+                count('cache_hits')
+            elif signature['size'] == meta['size']:
+                signature = file_signature(data, True)
+                if signature['sha256'] == meta['sha256']:
+                    # same content with a new mtime, store the new signature
+                    dataset = dataset_from(meta, arrays['matrix'], arrays['labels'])
+                    meta.update(signature)
+                    try:
+                        write_arrays(cache_path, 'Dataset', meta, {'matrix': dataset.matrix, 'labels': dataset.labels})
+                    except OSError:
+                        pass
+    if dataset is None:
+        dataset = Dataset.from_file(data)
+        if cache:
+            meta = dataset_meta(dataset)
+            if signature is None or 'sha256' not in signature:
+                signature = file_signature(data, True)
+            meta.update(signature)
+            try:
+                write_arrays(cache_path, 'Dataset', meta, {'matrix': dataset.matrix, 'labels': dataset.labels})
+            except OSError:
+                pass
+    if reference is not None:
+        dataset = dataset.recode(reference)
+    return dataset
+
+
+def dataset_chunks(data, reference, chunk_rows=65536):
+    """
+    Reads a file lazily, chunk_rows examples at a time, so a file larger
+    than the memory can be streamed
+    :param data: path of the file
+    :param reference: the dataset to take the vocabularies from
+    :param chunk_rows: number of examples in a chunk
+    :return: generator of Datasets encoded with the reference vocabularies
+    """
+    with open(data) as file:
+        file.readline()  # the features, the reference has them
+        while True:
+            lines = list(itertools.islice(file, chunk_rows))
+            if not lines:
+                return
+            rows = []
+            y_hat = []
+            for line in lines:
+                example = line.rstrip('\n').split('\t')
+                y_hat.append(example.pop())
+                rows.append(example)
+            count('bytes_read', sum(len(line) for line in lines))
+            count('rows_read', len(rows))
+            yield Dataset.from_rows(None, rows, y_hat, reference)
+
+
+def stream_test(model, data, reference, chunk_rows=65536):
+    """
+    Evaluates a model on a file chunk by chunk
+    :param model: a trained model
+    :param data: path of the test file
+    :param reference: the train dataset of the model
+    :param chunk_rows: number of examples in a chunk
+    :return: generator of (predictions of the chunk, accuracy so far)
+    """
+    correct = 0
+    total = 0
+    for batch in dataset_chunks(data, reference, chunk_rows):
+        predictions = model.predict(batch)
+        tags = batch.decode_labels(batch.labels)
+        correct += sum(1 for prediction, tag in zip(predictions, tags) if prediction == tag)
+        total += len(tags)
+        yield predictions, correct / total
+
+
 def chunks(dataset, n):
     """
     The function creates chunks of the dataset, used for cross validation with 5 sets
@@ -75,26 +220,30 @@ def create_other_sets(i, zipped):
     return other_set
 
 
-def k_fold_cross_validation(algo, features, train_set, y_hat):
+def k_fold_cross_validation(algo, features, train_set=None, y_hat=None, folds=5, seed=None):
     """
 
     :param algo: name of algorithm
-    :param features: features
-    :param train_set: the train_set
-    :param y_hat: the tags
+    :param features: features, or a Dataset holding the whole train data
+    :param train_set: the train_set, unused for a Dataset
+    :param y_hat: the tags, unused for a Dataset
+    :param folds: number of folds
+    :param seed: seed of the DecisionTree ties, see DecisionTree
     :return: a list of all the acc, and the average acc
     """
-    zipped = list(chunks(train_set, math.ceil(len(train_set) / 5)))
-    y_hat_zipped = list(chunks(y_hat, math.ceil(len(y_hat) / 5)))
+    if isinstance(features, Dataset):
+        return k_fold_cross_validation_dataset(algo, features, folds, seed)
+    zipped = list(chunks(train_set, math.ceil(len(train_set) / folds)))
+    y_hat_zipped = list(chunks(y_hat, math.ceil(len(y_hat) / folds)))
     accuracy_list = []
     average_accuracy = 0
-    for i in range(5):
+    for i in range(folds):
         acc = 0
         test_set = zipped[i]
         test_set_y_hat = y_hat_zipped[i]
         train_set_new = create_other_sets(i, zipped)
         train_set_y_hats_new = create_other_sets(i, y_hat_zipped)
-        model = create_model(algo, features, train_set_new, train_set_y_hats_new)
+        model = create_model(algo, features, train_set_new, train_set_y_hats_new, seed=seed)
         predictions = model.predict(test_set)
         length = len(predictions)
         for i in range(length):
@@ -104,11 +253,199 @@ def k_fold_cross_validation(algo, features, train_set, y_hat):
         acc = truncate_number(acc, 2)
         average_accuracy += acc
         accuracy_list.append(acc)
-    average_accuracy = average_accuracy / 5
+    average_accuracy = average_accuracy / folds
     average_accuracy = truncate_number(average_accuracy, 2)
     return accuracy_list, average_accuracy
 
 
+def fold_indices(length, folds=5):
+    """
+    The row indices of each fold, the same contiguous chunks as chunks()
+    :param length: number of rows
+    :param folds: number of folds
+    :return: list of index arrays
+    """
+    size = math.ceil(length / folds)
+    return [np.arange(start, min(start + size, length)) for start in range(0, length, size)]
+
+
+def other_folds(fold_rows, i):
+    """
+    :param fold_rows: the row indices of each fold
+    :param i: the fold left out
+    :return: the row indices of all the other folds
+    """
+    return np.concatenate(fold_rows[:i] + fold_rows[i + 1:])
+
+
+def average(accuracy_list):
+    """
+    :param accuracy_list: the acc of every fold
+    :return: the average acc, truncated like the acc
+    """
+    average_accuracy = 0
+    for acc in accuracy_list:
+        average_accuracy += acc
+    return truncate_number(average_accuracy / len(accuracy_list), 2)
+
+
+def fold_accuracy(algo, dataset, fold_rows, i, seed=None):
+    """
+    Trains on all the folds but one, and tests on that one
+    :param algo: name of algorithm
+    :param dataset: the Dataset
+    :param fold_rows: the row indices of each fold
+    :param i: the fold to test on
+    :param seed: seed of the DecisionTree ties
+    :return: the acc
+    """
+    test_set = dataset.take(fold_rows[i])
+    model = create_model(algo, dataset.take(other_folds(fold_rows, i)), seed=seed)
+    predictions = model.predict(test_set)
+    tags = test_set.decode_labels(test_set.labels)
+    acc = sum(1 for prediction, tag in zip(predictions, tags) if prediction == tag) / len(tags)
+    return truncate_number(acc, 2)
+
+
+def k_fold_cross_validation_dataset(algo, dataset, folds=5, seed=None):
+    """
+    The k_fold_cross_validation on an encoded dataset, the folds are views
+    on the dataset rows instead of copied lists
+    :param algo: name of algorithm
+    :param dataset: the Dataset
+    :param folds: number of folds
+    :param seed: seed of the DecisionTree ties
+    :return: a list of all the acc, and the average acc
+    """
+    fold_rows = fold_indices(len(dataset), folds)
+    if algo == 'NaiveBayes':
+        return naive_bayes_cross_validation(dataset, fold_rows)
+    if algo == 'KNN':
+        return knn_cross_validation(dataset, fold_rows, [5])[5]
+    accuracy_list = [fold_accuracy(algo, dataset, fold_rows, i, seed) for i in range(len(fold_rows))]
+    return accuracy_list, average(accuracy_list)
+
+
+def naive_bayes_cross_validation(dataset, fold_rows):
+    """
+    The k_fold_cross_validation of NaiveBayes by subtracting counts, the
+    counts of the whole dataset and of every fold are taken once, and the
+    model of a fold is the whole counts minus the counts of that fold
+    :param dataset: the Dataset
+    :param fold_rows: the row indices of each fold
+    :return: a list of all the acc, and the average acc
+    """
+    whole = NaiveBayes(dataset)
+    accuracy_list = []
+    for rows in fold_rows:
+        test_set = dataset.take(rows)
+        model = whole.copy().subtract(NaiveBayes(test_set))
+        predictions = model.predict(test_set)
+        tags = test_set.decode_labels(test_set.labels)
+        acc = sum(1 for prediction, tag in zip(predictions, tags) if prediction == tag) / len(tags)
+        accuracy_list.append(truncate_number(acc, 2))
+    return accuracy_list, average(accuracy_list)
+
+
+def cross_validation_job(shared, job):
+    """
+    One (algorithm, fold) job of parallel_cross_validation, run in a worker
+    :param shared: the dataset, the folds and the seed
+    :param job: (algorithm, fold)
+    :return: the acc
+    """
+    dataset, fold_rows, seed = shared
+    algo, i = job
+    return fold_accuracy(algo, dataset, fold_rows, i, seed)
+
+
+def parallel_cross_validation(algos, dataset, folds=5, workers=None, seed=None):
+    """
+    The k_fold_cross_validation of many algorithms, every (algorithm, fold)
+    is a job of a process pool. The workers are forked after the dataset is
+    published, so they share it instead of receiving copies, and the
+    results are collected in job order, as k_fold_cross_validation_dataset
+    with the same seed would return them
+    :param algos: names of algorithms
+    :param dataset: the Dataset
+    :param folds: number of folds
+    :param workers: number of processes, None for all the cores
+    :param seed: seed of the DecisionTree ties, random if None
+    :return: dictionary of algorithm to (a list of all the acc, the average acc)
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    fold_rows = fold_indices(len(dataset), folds)
+    jobs = [(algo, i) for algo in algos for i in range(len(fold_rows))]
+    accuracies = run_shared(cross_validation_job, (dataset, fold_rows, seed), jobs, workers)
+    result = {}
+    for index, algo in enumerate(algos):
+        accuracy_list = accuracies[index * len(fold_rows):(index + 1) * len(fold_rows)]
+        result[algo] = (accuracy_list, average(accuracy_list))
+    return result
+
+
+def knn_k_sweep_cross_validation(features, train_set=None, y_hat=None, ks=(1, 3, 5, 7, 9), folds=5):
+    """
+    The k_fold_cross_validation of KNN for many k values, every fold finds
+    the neighbors once for the largest k
+    :param features: features, or a Dataset holding the whole train data
+    :param train_set: the train_set, unused for a Dataset
+    :param y_hat: the tags, unused for a Dataset
+    :param ks: the k values
+    :param folds: number of folds
+    :return: dictionary of k to (a list of all the acc, the average acc)
+    """
+    dataset = features if isinstance(features, Dataset) else Dataset.from_rows(features, train_set, y_hat)
+    return knn_cross_validation(dataset, fold_indices(len(dataset), folds), ks)
+
+
+def knn_cross_validation(dataset, fold_rows, ks, max_bytes=TILE_BYTES):
+    """
+    The k_fold_cross_validation of KNN with the distances of every pair of
+    rows computed once, for all the folds. The neighbors of a row are
+    searched in the whole dataset with the rows of its own fold masked
+    out, which is the train set of its fold in the same order. When the
+    whole distance matrix fits in max_bytes it is one symmetric matrix
+    product, otherwise it is computed a block of rows at a time
+    :param dataset: the Dataset
+    :param fold_rows: the row indices of each fold
+    :param ks: the k values
+    :param max_bytes: memory budget of the distances
+    :return: dictionary of k to (a list of all the acc, the average acc)
+    """
+    length = len(dataset)
+    width = dataset.matrix.shape[1]
+    fold_of = np.empty(length, dtype=np.intp)
+    for fold, rows in enumerate(fold_rows):
+        fold_of[rows] = fold
+    model = KNN(dataset, k=max(ks))
+    if 4 * length * length <= max_bytes:
+        matches = model.one_hot @ model.one_hot.T
+        count('KNN.distance_computations', length * length)
+        blocks = [(0, width - matches.astype(np.int32))]
+    else:
+        model.tile_rows = max(1, max_bytes // (4 * max(1, length)))
+        blocks = model.distance_blocks(dataset.matrix)
+    predictions = {k: [] for k in ks}
+    for start, distances in blocks:
+        rows = np.arange(start, start + len(distances))
+        same_fold = fold_of[np.newaxis, :] == fold_of[rows][:, np.newaxis]
+        distances[same_fold] = width + 1  # farther than any row of the train set
+        neighbors = model.nearest(distances, max(ks))
+        for k in ks:
+            predictions[k].extend(model.vote_block(neighbors[:, :k]))
+    tags = dataset.decode_labels(dataset.labels)
+    result = {}
+    for k in ks:
+        accuracy_list = []
+        for rows in fold_rows:
+            acc = sum(1 for row in rows.tolist() if predictions[k][row] == tags[row]) / len(rows)
+            accuracy_list.append(truncate_number(acc, 2))
+        result[k] = (accuracy_list, average(accuracy_list))
+    return result
+
+
 def truncate_number(n, decimals=0):
     """
     Round the number 2 points after decimel
@@ -124,58 +461,109 @@ def truncate_number(n, decimals=0):
     return number
 
 
-def create_accuracy_file(features, train, y_hat):
+def create_accuracy_file(features, train=None, y_hat=None, folds=5, workers=1):
     """
     Create the accuracy.txt file
-    :param features: features
-    :param train: the train set
-    :param y_hat: the y_hat set
+    :param features: features, or a Dataset
+    :param train: the train set, unused for a Dataset
+    :param y_hat: the y_hat set, unused for a Dataset
+    :param folds: number of folds
+    :param workers: number of processes running the folds, None for all the cores
     :return:
     """
-    list_dt, avg_dt = k_fold_cross_validation('DecisionTree', features, train, y_hat)
-    list_bayes, avg_bayes = k_fold_cross_validation('NaiveBayes', features, train, y_hat)
-    list_knn, avg_knn = k_fold_cross_validation("KNN", features, train, y_hat)
+    with phase('cross_validation'):
+        if workers == 1:
+            list_dt, avg_dt = k_fold_cross_validation('DecisionTree', features, train, y_hat, folds)
+            list_bayes, avg_bayes = k_fold_cross_validation('NaiveBayes', features, train, y_hat, folds)
+            list_knn, avg_knn = k_fold_cross_validation("KNN", features, train, y_hat, folds)
+        else:
+            dataset = features if isinstance(features, Dataset) else Dataset.from_rows(features, train, y_hat)
+            result = parallel_cross_validation(['DecisionTree', 'NaiveBayes', 'KNN'], dataset, folds, workers)
+            avg_dt = result['DecisionTree'][1]
+            avg_bayes = result['NaiveBayes'][1]
+            avg_knn = result['KNN'][1]
     with open('accuracy.txt', 'w') as file:
         file.write(str(avg_dt) + '\t' + str(avg_knn) + '\t' + str(avg_bayes))
 
 
-def create_model(algo, given_features, given_train_set, given_y_hat):
+def create_model(algo, given_features, given_train_set=None, given_y_hat=None, k=5, seed=None):
     """
     Given an algorithm, builds the model
     :param algo: algorithm
-    :param given_features: features
-    :param given_train_set: the train set
-    :param given_y_hat: the y hat set
+    :param given_features: features, a Dataset or a WeightedDataset
+    :param given_train_set: the train set, unused for a Dataset
+    :param given_y_hat: the y hat set, unused for a Dataset
+    :param k: the k neighbors of KNN
+    :param seed: seed of the DecisionTree ties
     :return:
     """
     model = None
+    if isinstance(given_features, (Dataset, WeightedDataset)):
+        given_train_set = given_features
     if algo == 'KNN':
-        model = KNN(given_train_set, given_y_hat, 5)
+        model = KNN(given_train_set, given_y_hat, k)
     elif algo == 'NaiveBayes':
         model = NaiveBayes(given_features, given_train_set, given_y_hat)
     elif algo == 'DecisionTree':
-        model = DecisionTree(given_features, given_train_set, given_y_hat)
+        model = DecisionTree(given_features, given_train_set, given_y_hat, seed=seed)
     return model
 
 
-def create_output(features, train_set, y_hat, test_set, y_hat_test_set):
+def create_output(features, train_set, y_hat, test_set, y_hat_test_set, workers=3, collapse=False):
     """
     Creates the output.txt file
-    :param features: features
-    :param train_set: the train set
-    :param y_hat: the y hat set
-    :param test_set: the test set
-    :param y_hat_test_set: the y test hat set
+    :param features: features, or the train Dataset
+    :param train_set: the train set, unused for a Dataset
+    :param y_hat: the y hat set, unused for a Dataset
+    :param test_set: the test set, or a Dataset
+    :param y_hat_test_set: the y test hat set, may be None for a Dataset
+    :param workers: number of processes training the models at the same
+    time, None for all the cores
+    :param collapse: train on a WeightedDataset, the identical rows of the
+    train set collapsed, with the same models
     :return: nothing
     """
-    list_avg = []
-    knn = KNN(train_set, y_hat, 5)
-    nb = NaiveBayes(features, train_set, y_hat)
-    dt = DecisionTree(features, train_set, y_hat)
-    avg_knn = knn.test(test_set, y_hat_test_set)
-    avg_nb = nb.test(test_set, y_hat_test_set)
-    avg_dt = dt.test(test_set, y_hat_test_set)
-    list_avg.append(avg_dt)
-    list_avg.append(avg_knn)
-    list_avg.append(avg_nb)
-    dt.print_tree('output.txt', list_avg)
+    train_set = features if isinstance(features, Dataset) else Dataset.from_rows(features, train_set, y_hat)
+    if not isinstance(test_set, Dataset):
+        test_set = Dataset.from_rows(None, test_set, y_hat_test_set, train_set)
+    with phase('train'):
+        if collapse:
+            train_set = WeightedDataset(train_set)
+        dt, knn, nb = run_shared(train_job, train_set, ['DecisionTree', 'KNN', 'NaiveBayes'], workers)
+    with phase('evaluate'):
+        list_avg = evaluate_models([dt, knn, nb], test_set)
+    with phase('output'):
+        dt.print_tree('output.txt', list_avg)
+
+
+def train_job(dataset, algo):
+    """
+    Trains a model of create_output, run in a worker
+    :param dataset: the train Dataset or WeightedDataset
+    :param algo: name of algorithm
+    :return: the model
+    """
+    return create_model(algo, dataset)
+
+
+def evaluate_models(models, test_set, batch_rows=65536):
+    """
+    Tests many models in one pass over the test set, every batch of rows
+    is predicted by all the models before the next one is taken. The
+    identical rows of a batch are predicted once
+    :param models: the trained models
+    :param test_set: the test Dataset
+    :param batch_rows: number of rows in a batch
+    :return: the acc of every model, like their test()
+    """
+    correct = [0] * len(models)
+    for start in range(0, len(test_set), batch_rows):
+        batch = test_set.take(slice(start, start + batch_rows))
+        tags = batch.decode_labels(batch.labels)
+        first, inverse = unique_rows(batch.matrix)
+        distinct = batch.take(first)
+        for i, model in enumerate(models):
+            predictions = model.predict(distinct)
+            predictions = [predictions[row] for row in inverse.tolist()]
+            correct[i] += sum(1 for prediction, tag in zip(predictions, tags) if prediction == tag)
+    return [truncate_number(hits / len(test_set), 2) for hits in correct]